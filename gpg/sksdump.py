@@ -4,11 +4,16 @@
 
 import argparse
 import base64
+import concurrent.futures
 import configparser
 import datetime
 import getpass
+import hashlib
+import json
 import os
+import shutil
 import subprocess
+import time
 from pwd import getpwnam
 from grp import getgrnam
 
@@ -21,6 +26,13 @@ NOWstr = NOW.strftime('%Y-%m-%d')
 # - also, create the "CURRENT" symlink *AFTER* the dump completes?
 
 cfgfile = os.path.join(os.environ['HOME'], '.config', 'optools', 'sksdump.ini')
+# Dump files are binary (OpenPGP packets), so they're streamed through the
+# compressors in fixed-size blocks of this many bytes rather than by "line".
+BLOCKSIZE = 1048576
+# Written to each day's directory in incremental mode (see Compressor).
+MANIFEST = 'MANIFEST.json'
+# The last dump's files, in Compressor's workers (see initWorker()).
+_previous = {}
 
 def getDefaults():
     # Hardcoded defaults
@@ -30,14 +42,20 @@ def getDefaults():
                        'svcs': ['sks-db', 'sks-recon'],
                        'logfile': '/var/log/sksdump.log',
                        'days': 1,
-                       'dumpkeys': 15000},
+                       'dumpkeys': 15000,
+                       'splitkeys': 100,
+                       'workers': None,
+                       'xzthreads': 1},
             'sync': {'throttle': 0},
             'paths': {'basedir': '/var/lib/sks',
                       'destdir': '/srv/http/sks/dumps',
                       'rsync': ('root@mirror.square-r00t.net:' +
                                 '/srv/http/sks/dumps'),
                       'sksbin': '/usr/bin/sks'},
-            'runtime': {'nodump': None, 'nocompress': None, 'nosync': None}}
+            'runtime': {'nodump': None,
+                        'nocompress': None,
+                        'nosync': None,
+                        'incremental': None}}
     ## Build out the default .ini.
     dflt_b64 = ("""IyBJTVBPUlRBTlQ6IFRoaXMgc2NyaXB0IHVzZXMgY2VydGFpbiBwZXJtaXNz
                    aW9ucyBmdW5jdGlvbnMgdGhhdCByZXF1aXJlIHNvbWUKIyBmb3JldGhvdWdo
@@ -74,31 +92,57 @@ def getDefaults():
                    ZS4KbG9nZmlsZSA9IC92YXIvbG9nL3Nrc2R1bXAubG9nCgojIFRoZSBudW1i
                    ZXIgb2YgZGF5cyBvZiByb3RhdGVkIGtleSBkdW1wcy4gSWYgZW1wdHksIGRv
                    bid0IHJvdGF0ZS4KZGF5cyA9IDEKCiMgSG93IG1hbnkga2V5cyB0byBpbmNs
-                   dWRlIGluIGVhY2ggZHVtcCBmaWxlLgpkdW1wa2V5cyA9IDE1MDAwCgoKIyBU
-                   aGlzIHNlY3Rpb24gY29udHJvbHMgc3luYyBzZXR0aW5ncy4KW3N5bmNdCgoj
-                   IFRoaXMgc2V0dGluZyBpcyB3aGF0IHRoZSBzcGVlZCBzaG91bGQgYmUgdGhy
-                   b3R0bGVkIHRvLCBpbiBLaUIvcy4gSWYgZW1wdHkgb3IKIyAwLCBwZXJmb3Jt
-                   IG5vIHRocm90dGxpbmcuCnRocm90dGxlID0gMAoKCiMgVGhpcyBzZWN0aW9u
-                   IGNvbnRyb2xzIHdoZXJlIHN0dWZmIGdvZXMgYW5kIHdoZXJlIHdlIHNob3Vs
-                   ZCBmaW5kIGl0LgpbcGF0aHNdCgojIFdoZXJlIHlvdXIgU0tTIERCIGlzLgpi
-                   YXNlZGlyID0gL3Zhci9saWIvc2tzCgojIFRoaXMgaXMgdGhlIGJhc2UgZGly
-                   ZWN0b3J5IHdoZXJlIHRoZSBkdW1wcyBzaG91bGQgZ28uCiMgVGhlcmUgd2ls
-                   bCBiZSBhIHN1Yi1kaXJlY3RvcnkgY3JlYXRlZCBmb3IgZWFjaCBkYXRlLgpk
-                   ZXN0ZGlyID0gL3Nydi9odHRwL3Nrcy9kdW1wcwoKIyBUaGUgcGF0aCBmb3Ig
-                   cnN5bmNpbmcgdGhlIGR1bXBzLiBJZiBlbXB0eSwgZG9uJ3QgcnN5bmMuCnJz
-                   eW5jID0gcm9vdEBtaXJyb3Iuc3F1YXJlLXIwMHQubmV0Oi9zcnYvaHR0cC9z
-                   a3MvZHVtcHMKCiMgVGhlIHBhdGggdG8gdGhlIHNrcyBiaW5hcnkgdG8gdXNl
-                   Lgpza3NiaW4gPSAvdXNyL2Jpbi9za3MKCgojIFRoaXMgc2VjdGlvbiBjb250
-                   cm9scyBydW50aW1lIG9wdGlvbnMuIFRoZXNlIGNhbiBiZSBvdmVycmlkZGVu
-                   IGF0IHRoZQojIGNvbW1hbmRsaW5lLiBUaGV5IHRha2Ugbm8gdmFsdWVzOyB0
-                   aGV5J3JlIG1lcmVseSBvcHRpb25zLgpbcnVudGltZV0KCiMgRG9uJ3QgZHVt
-                   cCBhbnkga2V5cy4KIyBVc2VmdWwgZm9yIGRlZGljYXRlZCBpbi10cmFuc2l0
-                   L3ByZXAgYm94ZXMuCjtub2R1bXAKCiMgRG9uJ3QgY29tcHJlc3MgdGhlIGR1
-                   bXBzLCBldmVuIGlmIHdlIGhhdmUgYSBjb21wcmVzc2lvbiBzY2hlbWUgc3Bl
-                   Y2lmaWVkIGluCiMgdGhlIFtzeXN0ZW06Y29tcHJlc3NdIHNlY3Rpb246ZGly
-                   ZWN0aXZlLgo7bm9jb21wcmVzcwoKIyBEb24ndCBzeW5jIHRvIGFub3RoZXIg
-                   c2VydmVyL3BhdGgsIGV2ZW4gaWYgb25lIGlzIHNwZWNpZmllZCBpbiBbcGF0
-                   aHM6cnN5bmNdLgo7bm9zeW5j""")
+                   dWRlIGluIGVhY2ggZHVtcCBmaWxlLgpkdW1wa2V5cyA9IDE1MDAwCgojIElu
+                   IGluY3JlbWVudGFsIG1vZGUgKHNlZSBbcnVudGltZV0pLCBhYm91dCBob3cg
+                   bWFueSBrZXlzIGdvIGluIGVhY2ggb2YgdGhlCiMgZmlsZXMgdGhlIGR1bXAg
+                   aXMgc3BsaXQgaW50byAoaW5zdGVhZCBvZiBkdW1wa2V5cykuIFNtYWxsZXIg
+                   bWVhbnMgbW9yZSBmaWxlcywKIyBidXQgZmV3ZXIgb2YgdGhlbSBjaGFuZ2Ug
+                   ZnJvbSBvbmUgZGF5IHRvIHRoZSBuZXh0LiBJZiBlbXB0eSwgdXNlIDEwMC4K
+                   c3BsaXRrZXlzID0gMTAwCgojIEhvdyBtYW55IGR1bXAgZmlsZXMgdG8gY29t
+                   cHJlc3MgYXQgb25jZS4gSWYgZW1wdHksIHVzZSB0aGUgbnVtYmVyIG9mIENQ
+                   VXMuCndvcmtlcnMgPQoKIyBIb3cgbWFueSB0aHJlYWRzIGVhY2ggeHogY29t
+                   cHJlc3Npb24gZ2V0cy4gVGhpcyBuZWVkcyB0aGUgeHogYmluYXJ5CiMgKHB5
+                   dGhvbidzIGx6bWEgY2FuJ3QgZG8gbXVsdGl0aHJlYWRlZCBjb21wcmVzc2lv
+                   bik7IHdpdGhvdXQgaXQsIHRoaXMgaXMKIyBpZ25vcmVkLiBOb3RlIHRoYXQg
+                   YXQgcHJlc2V0IDkgeHogb25seSBzcGxpdHMgaW5wdXQgaW50byB+MTkyIE1p
+                   QiBibG9ja3MsIHNvCiMgdGhpcyBvbmx5IGhlbHBzIHdpdGggZHVtcCBmaWxl
+                   cyBiaWdnZXIgdGhhbiB0aGF0LiBJZiBlbXB0eSwgdXNlIDEuCnh6dGhyZWFk
+                   cyA9IDEKCgojIFRoaXMgc2VjdGlvbiBjb250cm9scyBzeW5jIHNldHRpbmdz
+                   Lgpbc3luY10KCiMgVGhpcyBzZXR0aW5nIGlzIHdoYXQgdGhlIHNwZWVkIHNo
+                   b3VsZCBiZSB0aHJvdHRsZWQgdG8sIGluIEtpQi9zLiBJZiBlbXB0eSBvcgoj
+                   IDAsIHBlcmZvcm0gbm8gdGhyb3R0bGluZy4KdGhyb3R0bGUgPSAwCgoKIyBU
+                   aGlzIHNlY3Rpb24gY29udHJvbHMgd2hlcmUgc3R1ZmYgZ29lcyBhbmQgd2hl
+                   cmUgd2Ugc2hvdWxkIGZpbmQgaXQuCltwYXRoc10KCiMgV2hlcmUgeW91ciBT
+                   S1MgREIgaXMuCmJhc2VkaXIgPSAvdmFyL2xpYi9za3MKCiMgVGhpcyBpcyB0
+                   aGUgYmFzZSBkaXJlY3Rvcnkgd2hlcmUgdGhlIGR1bXBzIHNob3VsZCBnby4K
+                   IyBUaGVyZSB3aWxsIGJlIGEgc3ViLWRpcmVjdG9yeSBjcmVhdGVkIGZvciBl
+                   YWNoIGRhdGUuCmRlc3RkaXIgPSAvc3J2L2h0dHAvc2tzL2R1bXBzCgojIFRo
+                   ZSBwYXRoIGZvciByc3luY2luZyB0aGUgZHVtcHMuIElmIGVtcHR5LCBkb24n
+                   dCByc3luYy4KcnN5bmMgPSByb290QG1pcnJvci5zcXVhcmUtcjAwdC5uZXQ6
+                   L3Nydi9odHRwL3Nrcy9kdW1wcwoKIyBUaGUgcGF0aCB0byB0aGUgc2tzIGJp
+                   bmFyeSB0byB1c2UuCnNrc2JpbiA9IC91c3IvYmluL3NrcwoKCiMgVGhpcyBz
+                   ZWN0aW9uIGNvbnRyb2xzIHJ1bnRpbWUgb3B0aW9ucy4gVGhlc2UgY2FuIGJl
+                   IG92ZXJyaWRkZW4gYXQgdGhlCiMgY29tbWFuZGxpbmUuIFRoZXkgdGFrZSBu
+                   byB2YWx1ZXM7IHRoZXkncmUgbWVyZWx5IG9wdGlvbnMuCltydW50aW1lXQoK
+                   IyBEb24ndCBkdW1wIGFueSBrZXlzLgojIFVzZWZ1bCBmb3IgZGVkaWNhdGVk
+                   IGluLXRyYW5zaXQvcHJlcCBib3hlcy4KO25vZHVtcAoKIyBEb24ndCBjb21w
+                   cmVzcyB0aGUgZHVtcHMsIGV2ZW4gaWYgd2UgaGF2ZSBhIGNvbXByZXNzaW9u
+                   IHNjaGVtZSBzcGVjaWZpZWQgaW4KIyB0aGUgW3N5c3RlbTpjb21wcmVzc10g
+                   c2VjdGlvbjpkaXJlY3RpdmUuCjtub2NvbXByZXNzCgojIERvbid0IHN5bmMg
+                   dG8gYW5vdGhlciBzZXJ2ZXIvcGF0aCwgZXZlbiBpZiBvbmUgaXMgc3BlY2lm
+                   aWVkIGluIFtwYXRoczpyc3luY10uCjtub3N5bmMKCiMgT25seSBjb21wcmVz
+                   cyBhbmQgc3luYyB0aGUgZHVtcCBmaWxlcyB0aGF0IGNoYW5nZWQgc2luY2Ug
+                   dGhlIGxhc3QgZHVtcC4gVGhlCiMga2V5cyBhcmUgc3BsaXQgaW50byBmaWxl
+                   cyBvbiBib3VuZGFyaWVzIHRoYXQgZG9uJ3QgbW92ZSBmcm9tIG9uZSBkdW1w
+                   IHRvIHRoZQojIG5leHQsIGZpbGVzIGlkZW50aWNhbCB0byB0aGUgbGFzdCBk
+                   dW1wJ3MgYXJlIGhhcmQgbGlua2VkIHRvIGl0IGluc3RlYWQgb2YKIyBiZWlu
+                   ZyBjb21wcmVzc2VkIGFnYWluLCBhbmQgYSBNQU5JRkVTVC5qc29uIGxpc3Rp
+                   bmcgZXZlcnkgZmlsZSdzIFNIQS0yNTYgaXMKIyB3cml0dGVuIHNvIG1pcnJv
+                   cnMgY2FuIGZldGNoIGp1c3QgdGhlIG9uZXMgdGhleSBkb24ndCBoYXZlLgoj
+                   IEEgZmlsZSBvbmx5IHN0YXlzIHRoZSBzYW1lIGlmIG5vbmUgb2YgaXRzIGtl
+                   eXMgY2hhbmdlZCwgc28gdXNlIGEgc3BsaXRrZXlzCiMgKGluIFtzeXN0ZW1d
+                   KSB0aGF0IGdpdmVzIHlvdSAobWFueSkgbW9yZSBmaWxlcyB0aGFuIGtleXMg
+                   Y2hhbmdlIGluIGEgZGF5Lgo7aW5jcmVtZW50YWw=""")
     realcfg = configparser.ConfigParser(defaults = dflt, allow_no_value = True)
     if not os.path.isfile(cfgfile):
         with open(cfgfile, 'w') as f:
@@ -116,15 +160,24 @@ def svcMgmt(op, args):
         subprocess.run(cmd)
     return()
 
-def destPrep(args):
+def destPrep(args, keep = None):
+    # keep is a dump directory to leave alone no matter how old it is (the
+    # last dump, in incremental mode, since we link to it).
     nowdir = os.path.join(args['destdir'], NOWstr)
     curdir = os.path.join(args['destdir'], 'current')
     PAST = NOW - datetime.timedelta(days = args['days'])
     for thisdir, dirs, files in os.walk(args['destdir'], topdown = False):
+        if keep and os.path.abspath(thisdir) == os.path.abspath(keep):
+            continue
+        # Files in an incremental dump can be hard links to (much) older ones,
+        # so the whole directory is as old as its manifest.
+        manifest = os.path.join(thisdir, MANIFEST)
+        dirtime = (os.stat(manifest).st_mtime
+                   if os.path.isfile(manifest) else None)
         for f in files:
             try:  # we use a try here because if the link's broken, the script bails out.
                 fstat = os.stat(os.path.join(thisdir, f))
-                mtime = fstat.st_mtime
+                mtime = (dirtime if dirtime else fstat.st_mtime)
                 if int(mtime) < PAST.timestamp():
                     os.remove(os.path.join(thisdir, f))
             except FileNotFoundError:  # broken symlink
@@ -164,82 +217,687 @@ def destPrep(args):
         pass  # Ignore if it was set earlier
     return()
 
-def dumpDB(args):
-    destPrep(args)
+def dumpDB(args, compressor = None):
+    # If a Compressor is given, each dump file is handed to it as soon as sks
+    # is done writing it (sks writes them one at a time, in order, so that's
+    # when the next one shows up or sks exits). Either way, the services are
+    # started again as soon as the dump itself is done; whatever hasn't been
+    # handed off by then is handed off after that.
+    # In incremental mode, sks' own files are hidden and get split up again
+    # by a KeySplitter (into files of about splitkeys keys), which hands *its*
+    # files to the Compressor.
+    destPrep(args, keep = (compressor.prevdir if compressor else None))
     os.chdir(args['basedir'])
     svcMgmt('stop', args)
+    dumpdir = os.path.join(args['destdir'], NOWstr)
+    splitter = None
+    if args['incremental']:
+        prefix = '.sks.{0}'.format(NOWstr)
+        splitter = KeySplitter(dumpdir,
+                               'keydump.{0}'.format(NOWstr),
+                               args['splitkeys'],
+                               compressor.submit,
+                               args['logfile'])
+    else:
+        prefix = 'keydump.{0}'.format(NOWstr)
     cmd = [args['sksbin'],
            'dump',
            str(args['dumpkeys']),  # How many keys per dump?
-           os.path.join(args['destdir'], NOWstr),  # Where should it go?
-           'keydump.{0}'.format(NOWstr)]  # What the filename prefix should be
+           dumpdir,  # Where should it go?
+           prefix]  # What the filename prefix should be
     if getpass.getuser() == 'root':
         cmd2 = ['sudo', '-u', args['user']]
         cmd2.extend(cmd)
         cmd = cmd2
-    with open(args['logfile'], 'a') as f:
-        f.write('===== {0} =====\n'.format(str(datetime.datetime.utcnow())))
-        subprocess.run(cmd, stdout = f, stderr = f)
-    svcMgmt('start', args)
+    def _dumps():
+        # (length first so -10000 sorts after -9999)
+        return([os.path.join(dumpdir, i)
+                for i in sorted((i for i in os.listdir(dumpdir)
+                                 if i.startswith(prefix) and
+                                 i.endswith('.pgp')),
+                                key = lambda i: (len(i), i))])
+    handoff = (splitter.feed if splitter else
+               (compressor.submit if compressor else None))
+    # Whatever goes wrong from here on, the services have to come back up;
+    # and sks has to be gone first, since it has the DB open.
+    proc = None
+    try:
+        with open(args['logfile'], 'a') as f:
+            f.write('===== {0} =====\n'.format(
+                                        str(datetime.datetime.utcnow())))
+            f.flush()
+            proc = subprocess.Popen(cmd, stdout = f, stderr = f)
+            while proc.poll() is None:
+                if compressor:
+                    # The newest one can still be getting written.
+                    for d in _dumps()[:-1]:
+                        handoff(d)
+                        # Splitting happens right here, so don't keep the
+                        # keyserver down for it once sks is done.
+                        if proc.poll() is not None:
+                            break
+                    compressor.poll()
+                time.sleep(1)
+    finally:
+        if proc and proc.poll() is None:
+            # We're bailing out early; let sks finish if it's quick about it.
+            try:
+                proc.wait(timeout = 30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        svcMgmt('start', args)
+    if compressor:
+        # The rest (at least the last one sks wrote), now that it's back up.
+        for d in _dumps():
+            handoff(d)
+        compressor.poll()
+    if splitter:
+        splitter.close()
+    return()
+
+def copyBlocks(fh_in, fh_out, blocksize = BLOCKSIZE):
+    # Copy fh_in to fh_out in blocksize chunks, reusing the same buffer so
+    # memory use is flat no matter how big the file is.
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        n = fh_in.readinto(buf)
+        if not n:
+            break
+        fh_out.write(view[:n])
     return()
 
-def compressDB(args):
-    if not args['compress']:
+def compressFile(fullpath, args):
+    # Compress (and then remove) a single dump file. This is module-level so
+    # it can be pickled for compressDB()'s process pool.
+    # Returns the new file's path, the original and compressed sizes, and how
+    # long it took (in seconds).
+    start = time.monotonic()
+    newfile = '{0}.{1}'.format(fullpath, args['compress'])
+    # Written to a hidden file first and renamed when it's done, so anything
+    # looking for compressed dumps (e.g. Compressor's rsync) only sees whole
+    # ones.
+    tmpfile = os.path.join(os.path.dirname(newfile),
+                           '.{0}.tmp'.format(os.path.basename(newfile)))
+    insize = os.path.getsize(fullpath)
+    # TODO: add compressed tarball support.
+    # However, I can't do this on memory-constrained systems for lrzip.
+    # See: https://github.com/kata198/python-lrzip/issues/1
+    if args['compress'].lower() == 'gz':
+        import gzip
+        with open(fullpath, 'rb') as fh_in, gzip.open(tmpfile,
+                                                      'wb') as fh_out:
+            copyBlocks(fh_in, fh_out)
+    elif args['compress'].lower() == 'xz':
+        xzbin = shutil.which('xz')
+        if args['xzthreads'] > 1 and xzbin:
+            # Same settings as below (preset 9|EXTREME), but multithreaded.
+            with open(fullpath, 'rb') as fh_in, open(tmpfile,
+                                                     'wb') as fh_out:
+                subprocess.run([xzbin,
+                                '-9e',
+                                '--threads={0}'.format(args['xzthreads']),
+                                '--stdout'],
+                               stdin = fh_in,
+                               stdout = fh_out,
+                               check = True)
+        else:
+            import lzma
+            with open(fullpath, 'rb') as fh_in, \
+                    lzma.open(tmpfile,
+                              'wb',
+                              preset = 9|lzma.PRESET_EXTREME) as fh_out:
+                copyBlocks(fh_in, fh_out)
+    elif args['compress'].lower() == 'bz2':
+        import bz2
+        with open(fullpath, 'rb') as fh_in, bz2.open(tmpfile,
+                                                     'wb') as fh_out:
+            copyBlocks(fh_in, fh_out)
+    elif args['compress'].lower() == 'lrz':
+        lrzbin = shutil.which('lrzip')
+        if lrzbin:
+            # python-lrzip only takes (and returns) the whole thing at once;
+            # the lrzip binary works through the file in windows that are
+            # sized to the available memory.
+            subprocess.run([lrzbin, '-q', '-f', '-o', tmpfile, fullpath],
+                           stdout = subprocess.DEVNULL,
+                           check = True)
+        else:
+            import lrzip
+            with open(fullpath, 'rb') as fh_in, open(tmpfile,
+                                                     'wb') as fh_out:
+                fh_out.write(lrzip.compress(fh_in.read()))
+    os.replace(tmpfile, newfile)
+    os.remove(fullpath)
+    if getpass.getuser() == 'root':
+        uid = getpwnam(args['user']).pw_uid
+        gid = getgrnam(args['group']).gr_gid
+        os.chown(newfile, uid, gid)
+    return((newfile,
+            insize,
+            os.path.getsize(newfile),
+            time.monotonic() - start))
+
+def hashFile(fpath, blocksize = BLOCKSIZE):
+    h = hashlib.sha256()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(fpath, 'rb') as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return(h.hexdigest())
+
+def initWorker(previous):
+    # Runs once in each of Compressor's worker processes: nice it so it
+    # doesn't slow down the dump, and hand it the last dump's files for
+    # storeFile() (once, instead of pickling them along with every file).
+    global _previous
+    os.nice(10)
+    _previous = previous
+    return()
+
+def storeFile(fullpath, args):
+    # The incremental version of compressFile(). _previous (see initWorker())
+    # maps the SHA-256 of each (uncompressed) file in the last dump to that
+    # file's manifest entry and path. If this file is identical to one of
+    # them, the last dump's compressed copy is hard linked in instead of
+    # compressing it again (and rsync -H then only has to send the link).
+    # Returns the same as compressFile(), plus this file's manifest entry.
+    start = time.monotonic()
+    keys_sha256 = hashFile(fullpath)
+    insize = os.path.getsize(fullpath)
+    prev = _previous.get(keys_sha256)
+    if prev and not os.path.isfile(prev['path']):
+        prev = None
+    if prev:
+        newfile = ('{0}.{1}'.format(fullpath, args['compress'])
+                   if args['compress'] else fullpath)
+        # Linked (or copied) to a hidden file first, same as compressFile();
+        # fullpath is only replaced or removed once that's worked.
+        tmpfile = os.path.join(os.path.dirname(newfile),
+                               '.{0}.tmp'.format(os.path.basename(newfile)))
+        try:
+            try:
+                os.link(prev['path'], tmpfile)
+            except OSError:  # e.g. the last dump is on another filesystem
+                shutil.copy2(prev['path'], tmpfile)
+        except OSError:
+            # e.g. it was rotated out in the meantime, or we're out of space;
+            # store it like a new file instead.
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            prev = None
+    if prev:
+        os.replace(tmpfile, newfile)
+        if newfile != fullpath:
+            os.remove(fullpath)
+        entry = dict(prev['entry'])
+        entry['name'] = os.path.basename(newfile)
+        return((newfile,
+                insize,
+                os.path.getsize(newfile),
+                time.monotonic() - start,
+                entry))
+    if args['compress']:
+        newfile, insize, outsize, _ = compressFile(fullpath, args)
+        sha256 = hashFile(newfile)
+    else:
+        newfile, outsize, sha256 = fullpath, insize, keys_sha256
+        if getpass.getuser() == 'root':
+            os.chown(newfile,
+                     getpwnam(args['user']).pw_uid,
+                     getgrnam(args['group']).gr_gid)
+    entry = {'name': os.path.basename(newfile),
+             'size': outsize,
+             'sha256': sha256,
+             'keys_size': insize,
+             'keys_sha256': keys_sha256,
+             'since': NOWstr}
+    return((newfile,
+            insize,
+            outsize,
+            time.monotonic() - start,
+            entry))
+
+def findPrevious(args):
+    # The most recent earlier dump with a manifest, as (path, manifest). If
+    # it was compressed differently, none of its files can be reused.
+    prevdir, manifest = None, None
+    if not os.path.isdir(args['destdir']):
+        return((prevdir, manifest))
+    for d in sorted(os.listdir(args['destdir']), reverse = True):
+        _dir = os.path.join(args['destdir'], d)
+        if d >= NOWstr or os.path.islink(_dir):
+            continue
+        if not os.path.isfile(os.path.join(_dir, MANIFEST)):
+            continue
+        with open(os.path.join(_dir, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        prevdir = _dir
+        break
+    if manifest and manifest.get('compress') != args['compress']:
+        manifest = None
+    return((prevdir, manifest))
+
+class KeySplitter(object):
+    # sks dumps a fixed number of keys per file, in the order of its key
+    # database, which is by a hash of each key's contents. So a single new or
+    # updated key shifts every file after it, and hardly any file is ever the
+    # same as the day before.
+    # This reads sks' files back (in order) and splits the keys up again,
+    # starting a new file whenever a key's primary key packet hashes to a
+    # multiple of dumpkeys (so about dumpkeys keys per file). That packet
+    # doesn't change when a key gets new signatures or user IDs, so each new
+    # or updated key only changes the file(s) it's added to or moved out of.
+    # Finished files are handed to submit() (i.e. Compressor.submit()).
+    # If it comes across anything it can't parse, the rest of that file is
+    # copied through as-is (and logged); it just won't be split as finely.
+    def __init__(self, dumpdir, prefix, dumpkeys, submit, logfile):
+        self.dumpdir = dumpdir
+        self.prefix = prefix
+        self.dumpkeys = dumpkeys
+        self.submit = submit
+        self.logfile = logfile
+        self.num = 0
+        self.keys = 0
+        self.fh = None
+        self.fpath = None
+
+    def feed(self, fpath):
+        # Split one of sks' files, then remove it. sks doesn't split keys
+        # across files.
+        # pos is where the next packet starts, start is the first byte that
+        # hasn't been written out yet, offset is where buf starts in fpath.
+        buf = bytearray()
+        pos = 0
+        start = 0
+        offset = 0
+        with open(fpath, 'rb') as fh_in:
+            while True:
+                pkt = self._packet(buf, pos)
+                if pkt is False:
+                    self._passthru(fpath,
+                                   fh_in,
+                                   buf[start:],
+                                   ('unparseable OpenPGP packet at byte '
+                                    '{0}').format(offset + pos))
+                    buf = bytearray()
+                    break
+                if not pkt:
+                    # Write out what we've got, and get more.
+                    self._write(buf[start:pos])
+                    del buf[:pos]
+                    offset += pos
+                    pos = start = 0
+                    data = fh_in.read(BLOCKSIZE)
+                    if not data:
+                        break
+                    buf += data
+                    continue
+                tag, hdrlen, bodylen = pkt
+                if tag == 6:  # Public-Key Packet, i.e. the start of a key.
+                    self._write(buf[start:pos])
+                    start = pos
+                    body = bytes(buf[pos + hdrlen:pos + hdrlen + bodylen])
+                    if self.keys and self._boundary(body):
+                        self._next()
+                    self.keys += 1
+                pos += hdrlen + bodylen
+            if buf:
+                self._passthru(fpath,
+                               fh_in,
+                               buf,
+                               ('truncated OpenPGP packet at byte '
+                                '{0}').format(offset))
+        os.remove(fpath)
+        return()
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.submit(self.fpath)
+            self.fh = None
+        return()
+
+    def _boundary(self, body):
+        h = hashlib.sha256(body).digest()
+        return((int.from_bytes(h[:8], 'big') % self.dumpkeys) == 0)
+
+    def _next(self):
+        self.close()
+        self.num += 1
+        return()
+
+    def _passthru(self, fpath, fh_in, data, why):
+        # Copy data and the rest of fh_in into the current file unchanged.
+        with open(self.logfile, 'a') as f:
+            f.write(('===== {0} WARNING: {1}: {2}; copying the rest of it '
+                     'unsplit =====\n').format(str(datetime.datetime.utcnow()),
+                                               fpath,
+                                               why))
+        while data:
+            self._write(data)
+            data = fh_in.read(BLOCKSIZE)
+        return()
+
+    def _write(self, data):
+        if not data:
+            return()
+        if not self.fh:
+            self.fpath = os.path.join(self.dumpdir,
+                                      '{0}-{1:04d}.pgp'.format(self.prefix,
+                                                               self.num))
+            self.fh = open(self.fpath, 'wb')
+        self.fh.write(data)
         return()
+
+    def _packet(self, buf, pos):
+        # Parse the OpenPGP packet header (RFC 4880 section 4.2) at pos.
+        # Returns the tag, header length and body length, None if buf
+        # doesn't have the whole packet yet, or False if it isn't a packet we
+        # can split on.
+        if pos >= len(buf):
+            return(None)
+        b = buf[pos]
+        if not b & 0x80:
+            return(False)  # Not an OpenPGP packet
+        if b & 0x40:  # New format
+            tag = b & 0x3f
+            if pos + 2 > len(buf):
+                return(None)
+            o1 = buf[pos + 1]
+            if o1 < 192:
+                hdrlen, bodylen = 2, o1
+            elif o1 < 224:
+                if pos + 3 > len(buf):
+                    return(None)
+                hdrlen, bodylen = 3, ((o1 - 192) << 8) + buf[pos + 2] + 192
+            elif o1 == 255:
+                if pos + 6 > len(buf):
+                    return(None)
+                hdrlen = 6
+                bodylen = int.from_bytes(buf[pos + 2:pos + 6], 'big')
+            else:
+                # Partial body lengths are only for data packets, which
+                # keys don't have.
+                return(False)
+        else:  # Old format
+            tag = (b >> 2) & 0x0f
+            lenlen = {0: 1, 1: 2, 2: 4}.get(b & 0x03)
+            if not lenlen:
+                return(False)  # Indeterminate length
+            if pos + 1 + lenlen > len(buf):
+                return(None)
+            hdrlen = 1 + lenlen
+            bodylen = int.from_bytes(buf[pos + 1:pos + hdrlen], 'big')
+        if pos + hdrlen + bodylen > len(buf):
+            return(None)
+        return((tag, hdrlen, bodylen))
+
+class Compressor(object):
+    # Runs compressFile() over a process pool. Dump files can be submitted as
+    # they become ready (see dumpDB()); results are logged as they finish.
+    # Every dump file is independent, and the compressors are CPU-bound. The
+    # workers are niced so they don't slow down the dump (which is what the
+    # keyserver is down for). The log is only written to from here.
+    # If we're syncing, the compressed files that are done are rsynced in the
+    # background while the rest are still going (see rsyncCmd()); syncDB()
+    # then only has whatever's left.
+    # In incremental mode, files go through storeFile() instead, and
+    # finish() writes the day's manifest: the name, size and SHA-256 of each
+    # file (and of the keys in it), and "since", the date of the first dump
+    # it's been identical in. A mirror with the dump it lists as "previous"
+    # only needs to fetch the files whose sha256 it doesn't already have.
+    def __init__(self, args):
+        self.args = args
+        self.workers = (args['workers'] if args['workers']
+                        else os.cpu_count())
+        self.futures = {}
+        self.submitted = set()
+        self.total_in = 0
+        self.total_out = 0
+        self.count = 0
+        self.failed = 0
+        self.rsync = None
+        self.unsynced = 0
+        self.linked = 0
+        self.entries = {}
+        self.previous = {}
+        self.prevdir, prevmanifest = None, None
+        if args['incremental']:
+            self.prevdir, prevmanifest = findPrevious(args)
+        if prevmanifest:
+            for entry in prevmanifest['files']:
+                self.previous[entry['keys_sha256']] = {
+                                'path': os.path.join(self.prevdir,
+                                                     entry['name']),
+                                'entry': entry}
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+                                            max_workers = self.workers,
+                                            initializer = initWorker,
+                                            initargs = (self.previous, ))
+        self.start = time.monotonic()
+        with open(args['logfile'], 'a') as f:
+            f.write(('===== {0} Now compressing with {1} ({2} '
+                     'workers) =====\n').format(str(datetime.datetime.utcnow()),
+                                                args['compress'],
+                                                self.workers))
+            if args['incremental']:
+                f.write(('===== {0} Incremental: comparing against {1} '
+                         '({2} files) =====\n').format(
+                                            str(datetime.datetime.utcnow()),
+                                            (self.prevdir if prevmanifest
+                                             else 'nothing'),
+                                            len(self.previous)))
+            if ((args['compress'] or '').lower() == 'xz' and
+                    args['xzthreads'] > 1 and not shutil.which('xz')):
+                f.write(('===== {0} WARNING: xz binary not found; each file '
+                         'will be compressed with 1 thread =====\n').format(
+                                            str(datetime.datetime.utcnow())))
+
+    def submit(self, fullpath):
+        if fullpath in self.submitted:
+            return()
+        self.submitted.add(fullpath)
+        if self.args['incremental']:
+            future = self.executor.submit(storeFile, fullpath, self.args)
+        else:
+            future = self.executor.submit(compressFile, fullpath, self.args)
+        self.futures[future] = fullpath
+        self.poll()
+        return()
+
+    def poll(self, wait = False):
+        # Log whatever's finished. With wait, keep going until everything is.
+        while self.futures:
+            done, _ = concurrent.futures.wait(
+                            self.futures,
+                            timeout = (None if wait else 0),
+                            return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                self._done(future)
+            self._sync()
+            if not wait:
+                break
+        return()
+
+    def finish(self):
+        self.poll(wait = True)
+        self.executor.shutdown()
+        if self.rsync:
+            self.rsync.wait()
+        if self.args['incremental']:
+            self._manifest()
+        elapsed = time.monotonic() - self.start
+        with open(self.args['logfile'], 'a') as f:
+            f.write(('===== {0} Compressed {1} files: {2} -> {3} bytes in '
+                     '{4:.2f}s ({5:.2f} MiB/s aggregate) =====\n').format(
+                                            str(datetime.datetime.utcnow()),
+                                            self.count,
+                                            self.total_in,
+                                            self.total_out,
+                                            elapsed,
+                                            (self.total_in / 1048576) /
+                                                max(elapsed, 0.000001)))
+            if self.failed:
+                f.write(('===== {0} WARNING: {1} files failed to compress '
+                         '=====\n').format(str(datetime.datetime.utcnow()),
+                                           self.failed))
+            if self.args['incremental']:
+                f.write(('===== {0} {1} of {2} files unchanged since the '
+                         'last dump =====\n').format(
+                                            str(datetime.datetime.utcnow()),
+                                            self.linked,
+                                            self.count))
+        return()
+
+    def _done(self, future):
+        fullpath = self.futures.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            # A bad file (or a full disk, or a compressor that fell over)
+            # shouldn't take the rest of the run down with it, especially
+            # while the keyserver is stopped. The file stays as it was; only
+            # compressFile()'s half-written temp file goes.
+            self.failed += 1
+            tmpfile = os.path.join(os.path.dirname(fullpath),
+                                   '.{0}.{1}.tmp'.format(
+                                            os.path.basename(fullpath),
+                                            self.args['compress']))
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            with open(self.args['logfile'], 'a') as f:
+                f.write(('===== {0} ERROR: Failed to compress {1}: {2} '
+                         '=====\n').format(str(datetime.datetime.utcnow()),
+                                           fullpath,
+                                           e))
+            return()
+        newfile, insize, outsize, elapsed = result[:4]
+        if self.args['incremental']:
+            entry = result[4]
+            self.entries[entry['name']] = entry
+            if entry['since'] != NOWstr:
+                self.linked += 1
+        self.count += 1
+        self.unsynced += 1
+        self.total_in += insize
+        self.total_out += outsize
+        with open(self.args['logfile'], 'a') as f:
+            f.write(('===== {0} Compressed {1}: {2} -> {3} bytes in '
+                     '{4:.2f}s ({5:.2f} MiB/s) =====\n').format(
+                                            str(datetime.datetime.utcnow()),
+                                            fullpath,
+                                            insize,
+                                            outsize,
+                                            elapsed,
+                                            (insize / 1048576) /
+                                                max(elapsed, 0.000001)))
+        return()
+
+    def _manifest(self):
+        # Written last (and atomically), so a mirror that sees it can get
+        # every file in it. If this isn't the day's first run (e.g. -D), keep
+        # the entries for files from earlier runs that are still there.
+        nowdir = os.path.join(self.args['destdir'], NOWstr)
+        manifest = os.path.join(nowdir, MANIFEST)
+        entries = {}
+        if os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                for entry in json.load(f)['files']:
+                    if os.path.isfile(os.path.join(nowdir, entry['name'])):
+                        entries[entry['name']] = entry
+        entries.update(self.entries)
+        tmpfile = os.path.join(nowdir, '.{0}.tmp'.format(MANIFEST))
+        with open(tmpfile, 'w') as f:
+            json.dump({'date': NOWstr,
+                       'previous': (os.path.basename(self.prevdir)
+                                    if self.previous else None),
+                       'compress': self.args['compress'],
+                       'files': [entries[i] for i in sorted(entries)]},
+                      f,
+                      indent = 1)
+        os.replace(tmpfile, manifest)
+        return()
+
+    def _sync(self):
+        if not self.args['rsync'] or self.args.get('nosync'):
+            return()
+        if not self.args['compress']:
+            return()  # There's nothing to tell finished files apart by.
+        if self.rsync and self.rsync.poll() is None:
+            return()  # The last one's still going.
+        if not self.unsynced:
+            return()
+        self.unsynced = 0
+        with open(self.args['logfile'], 'a') as f:
+            f.write(('===== {0} Rsyncing finished dump files to mirror '
+                     '=====\n').format(str(datetime.datetime.utcnow())))
+            f.flush()
+            self.rsync = subprocess.Popen(rsyncCmd(self.args,
+                                                   partial = True,
+                                                   prevdir = self.prevdir),
+                                          stdout = f,
+                                          stderr = f)
+        return()
+
+def compressDB(args, compressor = None):
+    # compressor is passed in if dumpDB() already started on it.
+    if not args['compress'] and not args['incremental']:
+        return()
+    if not compressor:
+        compressor = Compressor(args)
     curdir = os.path.join(args['destdir'], NOWstr)
+    ext = '.{0}'.format(args['compress'])
     # I use os.walk here because we might handle this differently in the
     # future...
     for thisdir, dirs, files in os.walk(curdir):
         files.sort()
         for f in files:
-            fullpath = os.path.join(thisdir, f)
-            newfile = '{0}.{1}'.format(fullpath, args['compress'])
-            # TODO: add compressed tarball support.
-            # However, I can't do this on memory-constrained systems for lrzip.
-            # See: https://github.com/kata198/python-lrzip/issues/1
-            with open(args['logfile'], 'a') as f:
-                f.write('===== {0} Now compressing {1} =====\n'.format(
-                                            str(datetime.datetime.utcnow()),
-                                                                    fullpath))
-            if args['compress'].lower() == 'gz':
-                import gzip
-                with open(fullpath, 'rb') as fh_in, gzip.open(newfile,
-                                                              'wb') as fh_out:
-                    fh_out.writelines(fh_in)
-            elif args['compress'].lower() == 'xz':
-                import lzma
-                with open(fullpath, 'rb') as fh_in, \
-                        lzma.open(newfile,
-                                  'wb',
-                                  preset = 9|lzma.PRESET_EXTREME) as fh_out:
-                    fh_out.writelines(fh_in)
-            elif args['compress'].lower() == 'bz2':
-                import bz2
-                with open(fullpath, 'rb') as fh_in, bz2.open(newfile,
-                                                             'wb') as fh_out:
-                    fh_out.writelines(fh_in)
-            elif args['compress'].lower() == 'lrz':
-                import lrzip
-                with open(fullpath, 'rb') as fh_in, open(newfile,
-                                                         'wb') as fh_out:
-                    fh_out.write(lrzip.compress(fh_in.read()))
-            os.remove(fullpath)
-            if getpass.getuser() == 'root':
-                uid = getpwnam(args['user']).pw_uid
-                gid = getgrnam(args['group']).gr_gid
-                os.chown(newfile, uid, gid)
+            # Skip anything that's already compressed (or being compressed).
+            if f.startswith('.') or f.endswith(ext) or f == MANIFEST:
+                continue
+            compressor.submit(os.path.join(thisdir, f))
+    compressor.finish()
     return()
 
+def rsyncCmd(args, partial = False, prevdir = None):
+    # In incremental mode, unchanged files are hard links to the last dump's
+    # (see storeFile()); with -H, rsync recreates the links on the mirror
+    # instead of sending them again.
+    if not partial:
+        cmd = ['rsync',
+               '-a',
+               '--delete',
+               os.path.join(args['destdir'], '.'),
+               args['rsync']]
+    else:
+        # Only today's finished compressed dumps; compressFile() writes to a
+        # hidden temporary file and renames it when it's done. No --delete,
+        # since the rest aren't there yet. The last dump is included (if
+        # given) so that -H can see what today's files are linked to.
+        cmd = ['rsync', '-a']
+        for d in ((NOWstr, os.path.basename(prevdir)) if prevdir
+                  else (NOWstr, )):
+            cmd.extend(['--include=/{0}/'.format(d),
+                        '--include=/{0}/*.{1}'.format(d, args['compress'])])
+        cmd.extend(['--exclude=*',
+                    os.path.join(args['destdir'], '.'),
+                    args['rsync']])
+    if args.get('incremental'):
+        cmd.insert(1, '-H')
+    if args['throttle'] > 0.0:
+        cmd.insert(-1, '--bwlimit={0}'.format(str(args['throttle'])))
+    return(cmd)
+
 def syncDB(args):
     if not args['rsync']:
         return()
-    cmd = ['rsync',
-           '-a',
-           '--delete',
-           os.path.join(args['destdir'], '.'),
-           args['rsync']]
-    if args['throttle'] > 0.0:
-        cmd.insert(-1, '--bwlimit={0}'.format(str(args['throttle'])))
+    cmd = rsyncCmd(args)
     with open(args['logfile'], 'a') as f:
         f.write('===== {0} Rsyncing to mirror =====\n'.format(
                                             str(datetime.datetime.utcnow())))
@@ -273,6 +931,22 @@ def parseArgs():
                       dest = 'compress',
                       choices = ['xz', 'gz', 'bz2', 'lrz', None],
                       help = 'The compression scheme to apply to the dumps.')
+    args.add_argument('-w',
+                      '--workers',
+                      default = (int(system['workers'])
+                                 if system.get('workers') else None),
+                      dest = 'workers',
+                      type = int,
+                      help = ('How many dump files to compress at once. ' +
+                              'Default is the number of CPUs.'))
+    args.add_argument('-T',
+                      '--xz-threads',
+                      default = (int(system['xzthreads'])
+                                 if system.get('xzthreads') else 1),
+                      dest = 'xzthreads',
+                      type = int,
+                      help = ('How many threads each xz compression ' +
+                              'gets (needs the xz binary).'))
     args.add_argument('-s',
                       '--services',
                       default = system['svcs'],
@@ -297,6 +971,15 @@ def parseArgs():
                       dest = 'dumpkeys',
                       type = int,
                       help = 'How many keys to put in each dump.')
+    args.add_argument('-k',
+                      '--splitkeys',
+                      default = (int(system['splitkeys'])
+                                 if system.get('splitkeys') else 100),
+                      dest = 'splitkeys',
+                      type = int,
+                      help = ('With -I/--incremental, about how many keys to ' +
+                              'put in each of the files the dump is split ' +
+                              'into (instead of -d/--dumpkeys). Default is 100'))
     args.add_argument('-b',
                       '--basedir',
                       default = paths['basedir'],
@@ -347,6 +1030,14 @@ def parseArgs():
                       action = 'store_true',
                       default = ('nosync' in runtime),
                       help = 'Don\'t sync the dumps to the remote server.')
+    args.add_argument('-I',
+                      '--incremental',
+                      dest = 'incremental',
+                      action = 'store_true',
+                      default = ('incremental' in runtime),
+                      help = ('Only compress and sync the dump files that ' +
+                              'changed since the last dump, and write a ' +
+                              'manifest for mirrors.'))
     varargs = vars(args.parse_args())
     return(varargs)
 
@@ -357,10 +1048,15 @@ def main():
     with open(args['logfile'], 'a') as f:
         f.write('===== {0} STARTING =====\n'.format(
                                             str(datetime.datetime.utcnow())))
+    if args['nocompress']:
+        args['compress'] = None
+    compressor = None
+    if args['compress'] or args['incremental']:
+        compressor = Compressor(args)
     if not args['nodump']:
-        dumpDB(args)
-    if not args['nocompress']:
-        compressDB(args)
+        dumpDB(args, compressor)
+    if compressor:
+        compressDB(args, compressor)
     if not args['nosync']:
         syncDB(args)
     with open(args['logfile'], 'a') as f:
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import grp
+import hashlib
+import os
+import pwd
+import random
+import resource
+import shutil
+import tempfile
+import time
+##
+import sksdump
+
+
+# Times each of sksdump's codecs over a synthetic key dump, comparing the old line-based copy (writelines() over
+# a binary file) with sksdump.compressFile()'s block streaming. Each run happens in a fresh process so the peak
+# RSS is for that run alone.
+# With -i/--incremental, it instead simulates two nights of "sks dump" over a synthetic keyring (with some keys
+# added and updated in between) and compares how much of the second dump is new with sks' own files vs. with
+# sksdump.KeySplitter's.
+
+def gen_dump(fpath, size, newlines = True):
+    # Real dumps are OpenPGP packets: mostly incompressible key material with some text (user IDs, etc.) mixed in.
+    # Without newlines, the whole file is one "line" as far as writelines() is concerned (the worst case).
+    uid = b'\xb4\x1fJohn Q. Keyholder <john@example.com>'
+    with open(fpath, 'wb') as fh:
+        written = 0
+        while written < size:
+            chunk = os.urandom(768) + uid * 8
+            if not newlines:
+                chunk = chunk.replace(b'\n', b'\x00')
+            fh.write(chunk)
+            written += len(chunk)
+    return()
+
+def gen_key(rnd, sigs):
+    # A (structurally) valid OpenPGP key: a public key packet, a user ID and some signatures. New-format headers
+    # with two-octet lengths.
+    def pkt(tag, body):
+        n = len(body) - 192
+        return(bytes([0xc0 | tag, (n >> 8) + 192, n & 0xff]) + body)
+    key = pkt(6, b'\x04' + rnd.randbytes(271))
+    key += pkt(13, 'Key Holder {0} <{0}@example.com>'.format(rnd.getrandbits(32)).encode('utf-8').ljust(200))
+    for i in range(sigs):
+        key += pkt(2, b'\x04' + rnd.randbytes(286))
+    return(key)
+
+def sks_dump(keys, dumpdir, prefix, dumpkeys):
+    # Like sks: dumpkeys keys per file, in order of a hash of each key.
+    keys = sorted(keys, key = lambda k: hashlib.md5(k).digest())
+    for i in range(0, len(keys), dumpkeys):
+        with open(os.path.join(dumpdir, '{0}-{1:04d}.pgp'.format(prefix, i // dumpkeys)), 'wb') as fh:
+            fh.write(b''.join(keys[i:i + dumpkeys]))
+    return()
+
+def file_hashes(dumpdir, prefix):
+    hashes = {}
+    for f in os.listdir(dumpdir):
+        if f.startswith(prefix):
+            hashes[sksdump.hashFile(os.path.join(dumpdir, f))] = os.path.getsize(os.path.join(dumpdir, f))
+    return(hashes)
+
+def delta(args, workdir):
+    rnd = random.Random(0)
+    keys = [gen_key(rnd, rnd.randint(1, 4)) for i in range(args['keys'])]
+    changed = int(len(keys) * args['changed'])
+    day2 = list(keys)
+    for i in rnd.sample(range(len(day2)), changed // 2):
+        day2[i] += gen_key(rnd, 1)[-290:]  # A new signature
+    day2.extend(gen_key(rnd, rnd.randint(1, 4)) for i in range(changed - changed // 2))
+    print('{0} keys, {1} of them new or updated the next day'.format(len(keys), changed))
+    results = {}
+    for day, daykeys in (('day1', keys), ('day2', day2)):
+        dumpdir = os.path.join(workdir, day)
+        os.makedirs(dumpdir)
+        sks_dump(daykeys, dumpdir, '.sks', args['dumpkeys'])
+        fixed = file_hashes(dumpdir, '.sks')
+        start = time.perf_counter()
+        splitter = sksdump.KeySplitter(dumpdir, 'keydump', args['dumpkeys'], (lambda f: None), os.devnull)
+        for f in sorted(os.listdir(dumpdir)):
+            splitter.feed(os.path.join(dumpdir, f))
+        splitter.close()
+        elapsed = time.perf_counter() - start
+        results[day] = (fixed, file_hashes(dumpdir, 'keydump'), elapsed)
+    for i, name in ((0, 'sks files'), (1, 'KeySplitter files')):
+        old, new = results['day1'][i], results['day2'][i]
+        newbytes = sum(size for h, size in new.items() if h not in old)
+        print('{0:>18}: {1:4d} of {2:4d} files ({3:6.2f}% of {4} bytes) changed'.format(
+                                                                    name,
+                                                                    len([h for h in new if h not in old]),
+                                                                    len(new),
+                                                                    newbytes / sum(new.values()) * 100,
+                                                                    sum(new.values())))
+    print('{0:>18}: {1:.2f}s ({2:.1f} MiB/s)'.format('splitting',
+                                                     results['day2'][2],
+                                                     sum(results['day2'][1].values()) / 1048576 /
+                                                        results['day2'][2]))
+    return()
+
+def old_compress(fullpath, codec):
+    # What compressDB() used to do.
+    newfile = '{0}.{1}'.format(fullpath, codec)
+    if codec == 'gz':
+        import gzip
+        opener = gzip.open
+    elif codec == 'bz2':
+        import bz2
+        opener = bz2.open
+    elif codec == 'xz':
+        import lzma
+        opener = (lambda f, m: lzma.open(f, m, preset = 9|lzma.PRESET_EXTREME))
+    if codec == 'lrz':
+        import lrzip
+        with open(fullpath, 'rb') as fh_in, open(newfile, 'wb') as fh_out:
+            fh_out.write(lrzip.compress(fh_in.read()))
+    else:
+        with open(fullpath, 'rb') as fh_in, opener(newfile, 'wb') as fh_out:
+            fh_out.writelines(fh_in)
+    os.remove(fullpath)
+    return(newfile)
+
+def new_compress(fullpath, codec):
+    # compressFile() chowns to these if we're root.
+    args = {'compress': codec,
+            'xzthreads': 1,
+            'user': pwd.getpwuid(os.getuid()).pw_name,
+            'group': grp.getgrgid(os.getgid()).gr_name}
+    return(sksdump.compressFile(fullpath, args)[0])
+
+def run(func, src, workdir, codec):
+    fullpath = os.path.join(workdir, 'keydump.0000.pgp')
+    shutil.copyfile(src, fullpath)
+    start = time.perf_counter()
+    newfile = func(fullpath, codec)
+    elapsed = time.perf_counter() - start
+    outsize = os.path.getsize(newfile)
+    os.remove(newfile)
+    return(elapsed, outsize, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark sksdump compression codecs.')
+    args.add_argument('-S', '--size',
+                      dest = 'size',
+                      type = int,
+                      default = 33554432,
+                      help = 'The size of the synthetic dump file in bytes. Default is 33554432 (32 MiB)')
+    args.add_argument('-c', '--codecs',
+                      dest = 'codecs',
+                      nargs = '+',
+                      default = ['gz', 'bz2', 'xz', 'lrz'],
+                      help = 'The codecs to try. Default is gz bz2 xz lrz')
+    args.add_argument('-N', '--no-newlines',
+                      dest = 'newlines',
+                      action = 'store_false',
+                      help = 'Generate a dump with no newline bytes at all (the worst case for the old method)')
+    args.add_argument('-d', '--dir',
+                      dest = 'dir',
+                      default = None,
+                      help = 'Where to create the test files. Default is the system temp directory')
+    args.add_argument('-i', '--incremental',
+                      dest = 'incremental',
+                      action = 'store_true',
+                      help = 'Simulate incremental dumps instead (see below options)')
+    args.add_argument('-k', '--keys',
+                      dest = 'keys',
+                      type = int,
+                      default = 200000,
+                      help = '(-i) How many keys in the synthetic keyring. Default is 200000')
+    args.add_argument('-K', '--dumpkeys',
+                      dest = 'dumpkeys',
+                      type = int,
+                      default = 1000,
+                      help = '(-i) How many keys per dump file. Default is 1000')
+    args.add_argument('-p', '--changed',
+                      dest = 'changed',
+                      type = float,
+                      default = 0.001,
+                      help = '(-i) The fraction of keys that are new or updated the next day. Default is 0.001')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    workdir = tempfile.mkdtemp(prefix = '.sksdump_bench.', dir = args['dir'])
+    try:
+        if args['incremental']:
+            delta(args, workdir)
+            return()
+        src = os.path.join(workdir, 'src.pgp')
+        gen_dump(src, args['size'], newlines = args['newlines'])
+        insize = os.path.getsize(src)
+        print('{0} bytes of synthetic dump'.format(insize))
+        for codec in args['codecs']:
+            for name, func in (('old', old_compress), ('new', new_compress)):
+                # A fresh process each time so ru_maxrss is just this run's.
+                with concurrent.futures.ProcessPoolExecutor(max_workers = 1) as executor:
+                    try:
+                        elapsed, outsize, rss = executor.submit(run, func, src, workdir, codec).result()
+                    except (ImportError, OSError) as e:
+                        print('{0:>4} {1}: skipped ({2})'.format(codec, name, e))
+                        continue
+                print('{0:>4} {1}: {2:7.2f}s ({3:6.2f} MiB/s), ratio {4:.3f}, peak RSS {5:7.1f} MiB'.format(
+                                                                                            codec,
+                                                                                            name,
+                                                                                            elapsed,
+                                                                                            insize / elapsed / 1048576,
+                                                                                            outsize / insize,
+                                                                                            rss / 1024))
+    finally:
+        shutil.rmtree(workdir)
+    return()
+
+if __name__ == '__main__':
+    main()
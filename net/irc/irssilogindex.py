@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Builds (and searches) a local full-text index of Irssi logs so you don't have
+# to decompress and strip every log on every search.
+# Lines go through the same pipeline as irssilogparse's plaintext output
+# (irssiLogParser.parser(), which uses plain_strip_line()) and are stored in a
+# SQLite FTS5 table as timestamp, channel, nick and message (and what kind of
+# line it was, so it can be shown the same way Irssi does).
+# Indexing is incremental:
+# - Logs that haven't changed (size and mtime) are skipped entirely.
+# - Uncompressed logs that have only been appended to (what Irssi does with
+#   the log it's currently writing) only have the new bytes read. A hash of
+#   the end of what we indexed last time is used to make sure it really was
+#   only appended to.
+# - Anything else (compressed logs that changed, truncated/rewritten logs) is
+#   dropped from the index and indexed again from the start.
+# Only complete lines are indexed; a partial last line (e.g. Irssi is halfway
+# through writing it) is picked up on the next run.
+
+import argparse
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import time
+##
+import irssilogparse
+
+
+# e.g. --- Log opened Mon Jan 01 00:00:00 2018
+#      --- Day changed Tue Jan 02 2018
+_day_re = re.compile(('^--- (?:Log opened|Day changed) [A-Za-z]{3} ([A-Za-z]{3}) +([0-9]{1,2}) '
+                      '(?:[0-9:]+ )?([0-9]{4})'))
+_months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+# e.g. 12:00:00 <@nick> message
+#      12:00 < nick> message
+#      12:00:00  * nick does something
+#      12:00:00 -!- nick [user@host] has joined #chan
+_line_re = re.compile(('^([0-9]{2}:[0-9]{2}(?::[0-9]{2})?) +'
+                       '(?:<[ ~&@%+]*([^>\\s]+)> ?|\\* +(\\S+) |-!- +(\\S+) )?'
+                       '(.*)$'))
+# How each kind of line is shown in search results.
+_kind_fmt = {'msg': '<{0}> {1}',
+             'action': '* {0} {1}',
+             'event': '-!- {0} {1}'}
+# e.g. #chan.log, #chan.2018-01-01.log, #chan_20180101.log.xz
+_chan_re = re.compile('^(.+?)(?:[._-][0-9]{4}(?:[-._]?[0-9]{2}){0,2})?(?:\\.log)?$')
+# How much of the end of the indexed part of a log to hash to check that it was only appended to.
+_tail_size = 4096
+
+
+class _LimitedReader(io.RawIOBase):
+    # Reads at most length bytes from fh (from wherever it currently is).
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.remaining = length
+
+    def readable(self):
+        return(True)
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return(0)
+        view = memoryview(b)[:self.remaining]
+        n = self.fh.readinto(view)
+        self.remaining -= n
+        return(n)
+
+
+def get_channel(logfile):
+    # Irssi's default autolog path is ~/irclogs/<network>/<channel>.log, and rotated logs usually have the date
+    # tacked on.
+    name = os.path.basename(logfile)
+    base, ext = os.path.splitext(name)
+    if ext in ('.bz2', '.gz', '.xz'):
+        name = base
+    return(_chan_re.match(name).group(1))
+
+def is_compressed(head):
+    return(any(head.startswith(sig) for sig in irssilogparse.cmprsn_sigs))
+
+
+class LogIndex(object):
+    def __init__(self, dbpath):
+        self.dbpath = os.path.abspath(os.path.expanduser(dbpath))
+        os.makedirs(os.path.dirname(self.dbpath), exist_ok = True)
+        self.db = sqlite3.connect(self.dbpath)
+        self.db.execute(('CREATE TABLE IF NOT EXISTS files ('
+                         'id INTEGER PRIMARY KEY, '
+                         'path TEXT NOT NULL UNIQUE, '
+                         'size INTEGER NOT NULL, '
+                         'mtime_ns INTEGER NOT NULL, '
+                         'offset INTEGER NOT NULL, '  # How far into the (uncompressed) log we've indexed
+                         'day TEXT, '  # The date as of offset (from the last "Log opened"/"Day changed")
+                         'tail TEXT)'))  # The hash of the _tail_size bytes before offset
+        self.db.execute(('CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5('
+                         'timestamp UNINDEXED, '
+                         'channel, '
+                         'nick, '
+                         'message, '
+                         'kind UNINDEXED, '  # msg, action, event or None
+                         'file_id UNINDEXED)'))
+        self.stats = {'skipped': 0,
+                      'appended': 0,
+                      'reindexed': 0,
+                      'lines': 0,
+                      'bytes': 0}
+
+    def index(self, logfile):
+        logfile = os.path.abspath(os.path.expanduser(logfile))
+        st = os.stat(logfile)
+        row = self.db.execute('SELECT id, size, mtime_ns, offset, day, tail FROM files WHERE path = ?',
+                              (logfile, )).fetchone()
+        if row and row[1] == st.st_size and row[2] == st.st_mtime_ns:
+            self.stats['skipped'] += 1
+            return()
+        with open(logfile, 'rb') as fh:
+            compressed = is_compressed(fh.read(8))
+            start = 0
+            day = None
+            if row and not compressed and st.st_size >= row[3] and self._tail(fh, row[3]) == row[5]:
+                start = row[3]
+                day = row[4]
+            if compressed:
+                # Compressed logs are only ever read whole; they're (almost always) rotated logs that are done
+                # being written to anyways.
+                end = st.st_size
+            else:
+                end = self._last_line(fh, start, st.st_size)
+            # Everything from here on for this log is one transaction, so an interrupted run never leaves the
+            # offset out of sync with the lines.
+            with self.db:
+                if row:
+                    file_id = row[0]
+                    if not start:
+                        # This is an FTS table, so it's a full scan; but it only happens for logs that got
+                        # rewritten.
+                        self.db.execute('DELETE FROM lines WHERE file_id = ?', (file_id, ))
+                else:
+                    file_id = self.db.execute(('INSERT INTO files (path, size, mtime_ns, offset) '
+                                               'VALUES (?, ?, ?, 0)'),
+                                              (logfile, st.st_size, st.st_mtime_ns)).lastrowid
+                fh.seek(start)
+                if compressed:
+                    data = fh
+                else:
+                    data = io.BufferedReader(_LimitedReader(fh, end - start))
+                parser = irssilogparse.irssiLogParser({'color': False, 'html': False, 'logfile': None},
+                                                      data = data)
+                day = self._insert(file_id, get_channel(logfile), parser.parser(), day)
+                tail = (None if compressed else self._tail(fh, end))
+                self.db.execute('UPDATE files SET size = ?, mtime_ns = ?, offset = ?, day = ?, tail = ? WHERE id = ?',
+                                (st.st_size, st.st_mtime_ns, end, day, tail, file_id))
+        self.stats['appended' if start else 'reindexed'] += 1
+        self.stats['bytes'] += (end - start)
+        return()
+
+    def _insert(self, file_id, channel, lines, day):
+        # Returns the date as of the last line, so an append can pick up where we left off.
+        def _rows():
+            nonlocal day
+            for line in lines:
+                m = _day_re.match(line)
+                if m:
+                    day = '{0}-{1:02d}-{2:02d}'.format(m.group(3),
+                                                       _months.index(m.group(1)) + 1,
+                                                       int(m.group(2)))
+                    continue
+                m = _line_re.match(line)
+                if not m:
+                    continue
+                tstamp = m.group(1)
+                if len(tstamp) == 5:
+                    tstamp += ':00'
+                if day:
+                    tstamp = '{0} {1}'.format(day, tstamp)
+                for kind, grp in (('msg', 2), ('action', 3), ('event', 4)):
+                    if m.group(grp):
+                        nick = m.group(grp)
+                        break
+                else:
+                    kind = None
+                    nick = ''
+                self.stats['lines'] += 1
+                yield((tstamp, channel, nick, m.group(5), kind, file_id))
+        self.db.executemany('INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)', _rows())
+        return(day)
+
+    def _tail(self, fh, offset):
+        start = max(0, offset - _tail_size)
+        fh.seek(start)
+        return(hashlib.sha1(fh.read(offset - start)).hexdigest())
+
+    def _last_line(self, fh, start, size):
+        # Where the last complete line ends (i.e. just past the last newline), or start if there isn't one.
+        pos = size
+        while pos > start:
+            chunk_start = max(start, pos - 65536)
+            fh.seek(chunk_start)
+            idx = fh.read(pos - chunk_start).rfind(b'\n')
+            if idx >= 0:
+                return(chunk_start + idx + 1)
+            pos = chunk_start
+        return(start)
+
+    def search(self, query = None, nick = None, channel = None, limit = None):
+        # query is FTS5 query syntax (e.g. 'foo bar', '"foo bar"', 'foo OR bar', 'foo*'). nick and channel narrow
+        # it down to those columns.
+        match = []
+        if query:
+            match.append('({0})'.format(query))
+        for col, val in (('nick', nick), ('channel', channel)):
+            if val:
+                match.append('{0} : "{1}"'.format(col, val.replace('"', '""')))
+        if not match:
+            raise ValueError('At least one of a query, nick or channel must be given')
+        sql = ('SELECT timestamp, channel, nick, message, kind FROM lines WHERE lines MATCH ? '
+               'ORDER BY timestamp, rowid')
+        params = [' AND '.join(match)]
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        try:
+            return(self.db.execute(sql, params).fetchall())
+        except sqlite3.OperationalError as e:
+            # Almost certainly a bad query.
+            raise ValueError('Could not search for {0!r}: {1}'.format(params[0], e))
+
+    def prune(self):
+        # Drop logs that no longer exist.
+        for file_id, path in self.db.execute('SELECT id, path FROM files').fetchall():
+            if not os.path.isfile(path):
+                with self.db:
+                    self.db.execute('DELETE FROM lines WHERE file_id = ?', (file_id, ))
+                    self.db.execute('DELETE FROM files WHERE id = ?', (file_id, ))
+        return()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        return()
+
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = ('Index Irssi logs for fast full-text searching, and search them.'))
+    args.add_argument('-d', '--db',
+                      dest = 'db',
+                      default = '~/.cache/irssilogindex.sqlite3',
+                      help = ('The path to the index. Default is ~/.cache/irssilogindex.sqlite3'))
+    args.add_argument('-i', '--index',
+                      dest = 'index',
+                      action = 'append',
+                      metavar = 'path/to/logfile',
+                      default = [],
+                      help = ('A log (or glob, e.g. "~/irclogs/*/*") to add to/update in the index. Can be given '
+                              'more than once. Only new logs and new lines are indexed'))
+    args.add_argument('-P', '--prune',
+                      dest = 'prune',
+                      action = 'store_true',
+                      help = ('Drop logs that no longer exist from the index'))
+    args.add_argument('-n', '--nick',
+                      dest = 'nick',
+                      default = None,
+                      help = ('Only show lines from this nick'))
+    args.add_argument('-c', '--channel',
+                      dest = 'channel',
+                      default = None,
+                      help = ('Only show lines from this channel'))
+    args.add_argument('-l', '--limit',
+                      dest = 'limit',
+                      type = int,
+                      default = None,
+                      help = ('Show at most this many lines'))
+    args.add_argument('-s', '--stats',
+                      dest = 'stats',
+                      action = 'store_true',
+                      help = ('Print indexing/search statistics to stderr'))
+    args.add_argument('query',
+                      nargs = '*',
+                      help = ('What to search for (SQLite FTS5 query syntax, e.g. "foo bar", \'"foo bar"\', '
+                              '"foo OR bar", "foo*")'))
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    idx = LogIndex(args['db'])
+    try:
+        start = time.perf_counter()
+        for logfile in irssilogparse.get_logfiles(args['index']):
+            idx.index(logfile)
+        if args['prune']:
+            idx.prune()
+        if args['stats'] and (args['index'] or args['prune']):
+            # TODO: logger?
+            print(('Indexed {0[lines]} lines ({0[bytes]} bytes) from {0[reindexed]} new/rewritten and {0[appended]} '
+                   'appended logs, skipped {0[skipped]} unchanged, in {1:.2f}s').format(idx.stats,
+                                                                                     time.perf_counter() - start),
+                  file = sys.stderr)
+        if args['query'] or args['nick'] or args['channel']:
+            start = time.perf_counter()
+            try:
+                results = idx.search(query = ' '.join(args['query']),
+                                     nick = args['nick'],
+                                     channel = args['channel'],
+                                     limit = args['limit'])
+            except (ValueError, sqlite3.OperationalError) as e:
+                # e.g. an unbalanced " or a bare AND in the query.
+                exit('ERROR: {0}'.format(e))
+            elapsed = time.perf_counter() - start
+            for tstamp, channel, nick, msg, kind in results:
+                print('{0} {1} {2}'.format(tstamp, channel, _kind_fmt.get(kind, '{1}').format(nick, msg)))
+            if args['stats']:
+                print('{0} results in {1:.1f} ms'.format(len(results), elapsed * 1000), file = sys.stderr)
+    finally:
+        idx.close()
+    return()
+
+if __name__ == '__main__':
+    main()
@@ -38,18 +38,27 @@
 # the names are obtuse and perl's ugly af.
 
 import argparse
+import collections
+import concurrent.futures
 import curses
+import glob
+import html
+import importlib
+import io
 import os
 import pprint
 import re
+import shutil
 import sys
+import tempfile
 try:
     import magic
     has_magic = True
 except ImportError:
     print('Warning: you do not have the magic module installed (you can '
           'install it via "pip3 install --user file-magic"). Automatic log '
-          'decompression will not work.')
+          'decompression will only detect bzip2, gzip, and xz by their '
+          'signatures.')
     has_magic = False
 
 # This is a map to determine which module to use to decompress,
@@ -59,7 +68,12 @@ cmprsn_map = {'text/plain': None,  # Plain ol' text
               'application/octet-stream': None,
               'application/x-bzip2': 'bz2',  # Bzip2
               'application/x-gzip': 'gzip',  # Gzip
+              'application/gzip': 'gzip',  # Gzip (newer libmagic)
               'application/x-xz': 'lzma'}  # XZ
+# If we don't have magic, we fall back to checking the first few bytes.
+cmprsn_sigs = {b'BZh': 'bz2',
+               b'\x1f\x8b': 'gzip',
+               b'\xfd7zXZ\x00': 'lzma'}
 
 # irssi/mIRC to ANSI
 # Split into 3 maps (truecolor will be populated later, currently uses 8-bit):
@@ -145,7 +159,7 @@ invert_char = '\x1b[7m'
 irssi_ctrl = {'a': '\x1b[5m',  # Blink
               'b': '\x1b[4m',  # Underline
               'c': bold_char,  # Bold
-              'd': invert_char,  # Reverse (unused; color_inverter() is called)
+              'd': invert_char,  # Reverse (unused; ColorConverter toggles it)
               #'e': '\t',  # Indent
               'e': None,  # Indent
               'f': None,  # "f" is an indent func, so no-op
@@ -162,18 +176,18 @@ irssi_ctrl = {'a': '\x1b[5m',  # Blink
 def_fg = '\x1b[39m'
 # the value to reset the background text (not changed)
 def_bg = '\x1b[49m'
-# if the state is currently inverted (dynamic)
-is_inverted = False
+# mIRC toggles: (on, off)
+toggle_chars = {'\x02': ('\x1b[1m', '\x1b[22m'),  # Bold
+                '\x1d': ('\x1b[3m', '\x1b[23m'),  # Italic
+                '\x1f': ('\x1b[4m', '\x1b[24m'),  # Underline
+                '\x16': (invert_char, '\x1b[27m'),  # Reverse (mIRC)
+                '\x04d': (invert_char, '\x1b[27m')}  # Reverse (Irssi)
 
 def get_palette():
     # Return 8, 256, or 'truecolor'
     colorterm = os.getenv('COLORTERM', None)
     if colorterm in ('truecolor', '24bit'):
-        # TODO: 24-bit support (16777216 colors) instead of 8-bit.
-        # See note above.
-        #return('truecolor')
-        #return(256)
-        return(8)
+        return('truecolor')
     else:
         curses.initscr()
         curses.start_color()
@@ -181,154 +195,357 @@ def get_palette():
         curses.endwin()
         return(c)
 
-def color_inverter(data = None):
-    # global fg
-    # global bg
-    global is_inverted
-    #fg, bg = bg, fg
-    if is_inverted:
-        char = '\x1b[27m'
-    else:
-        char = '\x1b[7m'
-    is_inverted = (not is_inverted)
-    return(char)
+class ColorConverter(object):
+    # Converts mIRC/Irssi color coding to ANSI color codes.
+    # Nothing here depends on what came before it on the line except the
+    # nick field and the toggles, and both of those are handled with a
+    # substitution over the whole input first. That makes every other
+    # control sequence a static lookup, so convert() can be given a single
+    # line or a whole block of them (which is a lot faster).
+    # One regex catches every other control sequence we handle:
+    # - ^C with an optional fg[,bg] (1 or 2 digits each)
+    # - ^D with an Irssi color (0-9) or control char (a-h, ;, >)
+    # - ^O
+    _token_re = re.compile('\x03(?:([0-9]{1,2})(?:,([0-9]{1,2}))?)?|'
+                           '\x04(?:([0-9;>])/?|([a-h]))|'
+                           '\x0f')
+    # The same thing, but for re.split() (so we get the whole sequence only).
+    _split_re = re.compile('({0})'.format(re.sub(r'\((?!\?:)', '(?:', _token_re.pattern)))
+    # The first ^D8/ (and any following whitespace) on a line is the nick
+    # field; it gets cleaned up to a single space.
+    # (These are all "unrolled" instead of using a lazy match; it's quite a
+    # bit faster.)
+    _nick_re = re.compile('(?m)^([^\n\x04]*(?:\x04(?!8/)[^\n\x04]*)*)\x048/[^\S\n]*')
+    # Toggles (^B, ^V, ^], ^_, ^Dd) turn their attribute on and off until a
+    # reset (^O/^Dg) or the end of the line. Pairs get replaced first; any
+    # left over after that are an "on" that never got turned off.
+    _toggle_subs = []
+    for _tok, (_on, _off) in toggle_chars.items():
+        _text = '[^\x04\x0f\n{0}]*'.format(re.escape(_tok[0]))
+        _ptrn = re.compile('{0}({1}(?:\x04(?![g{2}]){1})*){0}'.format(re.escape(_tok), _text, _tok[1:]))
+        _toggle_subs.append((_tok, _ptrn, _on, _off))
+    del(_tok, _on, _off, _text, _ptrn)
+
+    def __init__(self, palette = 8):
+        # curses may report e.g. 16 or 88 colors; use the best map we have.
+        if palette not in colormap:
+            palette = (256 if palette >= 256 else 8)
+        self.palette = palette
+        self._colors = colormap[palette]
+        # Conversions keyed on the raw sequence.
+        self._cache = {'\x0f': reset_char}
+
+    def convert(self, data):
+        # data should not have a trailing newline.
+        # (A function is faster than a template for re.sub() on 3.11 and
+        # older.)
+        data = self._nick_re.sub(lambda m: m.group(1) + ' ', data)
+        for tok, ptrn, on, off in self._toggle_subs:
+            if tok in data:
+                data = ptrn.sub(lambda m: on + m.group(1) + off, data).replace(tok, on)
+        # Every odd index is a control sequence, every even one is text.
+        pieces = self._split_re.split(data)
+        cache = self._cache
+        for idx in range(1, len(pieces), 2):
+            out = cache.get(pieces[idx])
+            if out is None:
+                out = self._convert_token(pieces[idx])
+            pieces[idx] = out
+        # Every line ends in a reset, but we don't need two of them.
+        data = ''.join(pieces).replace('\n', reset_char + '\n')
+        data = data.replace(reset_char + reset_char + '\n', reset_char + '\n')
+        if not data.endswith(reset_char):
+            data += reset_char
+        return(data)
 
+    def _convert_token(self, tok):
+        # Only the first time we see a given sequence.
+        m = self._token_re.match(tok)
+        if tok.startswith('\x03'):
+            if not m.group(1):
+                out = def_fg + def_bg
+            else:
+                out = self._color(m.group(1), m.group(2))
+        elif m.group(3):
+            ctrl = m.group(3)
+            if ctrl.isdigit():
+                out = self._color(ctrl)
+            else:
+                out = irssi_ctrl[ctrl]
+        else:
+            out = (irssi_ctrl[m.group(4)] or '')
+        self._cache[tok] = out
+        return(out)
+
+    def _color(self, fg, bg = None):
+        # Colors are given as 1 or 2 digits; the maps use the plain number.
+        # Anything outside of the 16 mIRC colors is dropped.
+        fg = self._colors.get(str(int(fg)))
+        if bg is not None:
+            bg = self._colors.get(str(int(bg)))
+        if fg is None:
+            return('')
+        wrap = self._colors['ansi_wrap']
+        out = wrap['fg'].format(fg)
+        if bg is not None:
+            out += wrap['bg'].format(bg)
+        elif self.palette == 8:
+            out += 'm'
+        return(out)
 
 def color_converter(data_in, palette_map):
     # Only used if logParser().args['color'] = True
     # Convert mIRC/Irssi color coding to ANSI color codes.
-    # A sub-function that generates the replacement characters.
-    global fg
-    global bg
-    global is_inverted
-    _colors = colormap[palette_map]
-    def _repl(ch_in):
-        ch_out = ''
-        _ch = {'stripped': re.sub('^[\x00-\x7f]', '', ch_in.group()),
-               #'ctrl': re.sub('^\x04([a-h]|[0-9]|;|>)/?.*$', '\g<1>',
-               'ctrl': re.sub('^\x04([^/])/?.*$', '\g<1>',
-                              ch_in.group())}
-        # We assign this separately as we use an existing dict entry.
-        # This is the "color code" (if it exists).
-        _ch['c'] = [re.sub('^0?([0-9]{1,2}).*',
-                           '\g<1>',
-                           i.strip()) for i in _ch['stripped'].split(',', 1)]
-        # Color-handling
-        #if _ch['ctrl'].startswith('\x03'):
-        if re.search('[\x00-\x03]', _ch['ctrl']):
-            if len(_ch['c']) == 1:
-                fg_only = True
-            elif len(_ch['c']) == 2:
-                fg_only = False
-            else:
-                raise RuntimeError('Parsing error! "{0}"'.format(
-                                                                ch_in.group()))
-            fg = _colors['ansi_wrap']['fg'].format(_colors[_ch['c'][0]])
-            ch_out = fg
-            if not fg_only:
-                bg = _colors['ansi_wrap']['bg'].format(_colors[_ch['c'][1]])
-                ch_out += bg
+    return(ColorConverter(palette_map).convert(data_in))
+
+# HTML output uses CSS classes instead of inline styles (it's MUCH smaller).
+# - fg0-fg15/bg0-bg15: the mIRC colors (from the truecolor map)
+# - fgr/bgr: the default colors, swapped (for reverse with no color set)
+# - b, i, u, blink: bold, italic, underline, blink
+html_attrs = ('b', 'i', 'u', 'rev', 'blink')
+# Which attribute each toggle flips.
+html_toggles = {'\x02': 'b',
+                '\x1d': 'i',
+                '\x1f': 'u',
+                '\x16': 'rev',
+                '\x04d': 'rev'}
+# Which attribute Irssi's ^D controls turn on (the rest are no-ops for us).
+html_irssi_ctrl = {'a': 'blink',
+                   'b': 'u',
+                   'c': 'b',
+                   '>': 'b',
+                   ';': 'b'}
+html_fg = '#d2d2d2'
+html_bg = '#000000'
+
+def get_html_css():
+    css = ['pre.irc {{ color: {0}; background-color: {1}; }}'.format(html_fg,
+                                                                    html_bg),
+           '.fgr {{ color: {0}; }}'.format(html_bg),
+           '.bgr {{ background-color: {0}; }}'.format(html_fg),
+           '.b { font-weight: bold; }',
+           '.i { font-style: italic; }',
+           '.u { text-decoration: underline; }',
+           '.blink { text-decoration: blink; }',
+           '.u.blink { text-decoration: underline blink; }']
+    for c in range(16):
+        rgb = 'rgb({0})'.format(', '.join(colormap['truecolor'][str(c)]))
+        css.append('.fg{0} {{ color: {1}; }}'.format(c, rgb))
+        css.append('.bg{0} {{ background-color: {1}; }}'.format(c, rgb))
+    return('\n'.join(css))
+
+def html_header(title = 'IRC log'):
+    return(('<!DOCTYPE html>\n'
+            '<html>\n'
+            '<head>\n'
+            '<meta charset="utf-8">\n'
+            '<title>{0}</title>\n'
+            '<style>\n'
+            '{1}\n'
+            '</style>\n'
+            '</head>\n'
+            '<body>\n'
+            '<pre class="irc">\n').format(html.escape(title),
+                                          get_html_css()))
+
+html_footer = ('</pre>\n'
+               '</body>\n'
+               '</html>\n')
+
+class HTMLConverter(object):
+    # Converts mIRC/Irssi color coding to HTML <span>s. Unlike ANSI, we need
+    # to know the full style of each run of text (not just what changed),
+    # so this tracks the state as it goes. Adjacent runs of text with the
+    # same style end up in the same <span>. Like ColorConverter.convert(),
+    # convert() can take a single line or a block of them; the output has
+    # no header/footer (see html_header() and html_footer).
+    _token_re = re.compile('\x03(?:([0-9]{1,2})(?:,([0-9]{1,2}))?)?|'
+                           '\x04(?:([0-9;>])/?|([a-h]))|'
+                           '[\x02\x0f\x16\x1d\x1f\n]')
+    _split_re = re.compile('({0})'.format(re.sub(r'\((?!\?:)', '(?:', _token_re.pattern)))
+    # Any control characters left over once the above are handled (e.g. the
+    # \x01s around CTCP ACTIONs) are dropped, as in plain_strip_line(); they
+    # aren't allowed in XHTML. Tabs are kept.
+    _ctrl_re = re.compile('[\x00-\x08\x0b-\x1f]')
+
+    def __init__(self):
+        # The CSS classes for a given state, keyed on the state tuple.
+        self._classes = {}
+        self.state = None
+        self._reset()
+
+    def convert(self, data):
+        # data should not have a trailing newline.
+        data = ColorConverter._nick_re.sub(lambda m: m.group(1) + ' ', data)
+        pieces = self._split_re.split(data)
+        out = []
+        self._reset()
+        cur = ''  # The classes of the currently open span (if any)
+        for idx, piece in enumerate(pieces):
+            if idx % 2:
+                if piece == '\n':
+                    if cur:
+                        out.append('</span>')
+                        cur = ''
+                    out.append('\n')
+                    self._reset()
+                else:
+                    self._apply(piece)
+                continue
+            piece = self._ctrl_re.sub('', piece)
+            if not piece:
+                continue
+            key = (self.fg, self.bg) + tuple(self.state[a] for a in html_attrs)
+            cls = self._classes.get(key)
+            if cls is None:
+                cls = self._classes[key] = self._get_classes(key)
+            if cls != cur:
+                if cur:
+                    out.append('</span>')
+                if cls:
+                    out.append('<span class="{0}">'.format(cls))
+                cur = cls
+            out.append(html.escape(piece, quote = False))
+        if cur:
+            out.append('</span>')
+        return(''.join(out))
+
+    def _reset(self):
+        self.fg = None
+        self.bg = None
+        self.state = dict.fromkeys(html_attrs, False)
+        return()
+
+    def _apply(self, tok):
+        if tok in html_toggles:
+            attr = html_toggles[tok]
+            self.state[attr] = (not self.state[attr])
+            return()
+        if tok == '\x0f':
+            self._reset()
+            return()
+        m = self._token_re.match(tok)
+        if tok.startswith('\x03'):
+            if not m.group(1):
+                self.fg = None
+                self.bg = None
+            elif int(m.group(1)) < 16:
+                # Same as the ANSI output; colors outside of the 16 mIRC
+                # colors are dropped (bg included).
+                self.fg = int(m.group(1))
+                if m.group(2) and int(m.group(2)) < 16:
+                    self.bg = int(m.group(2))
+        elif m.group(3):
+            ctrl = m.group(3)
+            if ctrl.isdigit():
+                self.fg = int(ctrl)
             else:
-                if palette_map == 8:
-                    ch_out += 'm'
-        # Control-character handling
+                self.state[html_irssi_ctrl[ctrl]] = True
+        elif m.group(4) == 'g':
+            self._reset()
+        elif m.group(4) in html_irssi_ctrl:
+            self.state[html_irssi_ctrl[m.group(4)]] = True
+        return()
+
+    def _get_classes(self, key):
+        fg, bg, *attrs = key
+        state = dict(zip(html_attrs, attrs))
+        cls = []
+        if state['rev']:
+            cls.append(('fg{0}'.format(bg) if bg is not None else 'fgr'))
+            cls.append(('bg{0}'.format(fg) if fg is not None else 'bgr'))
         else:
-            if _ch['ctrl'] in irssi_ctrl:
-                if irssi_ctrl[_ch['ctrl']]:
-                    ch_out = irssi_ctrl[_ch['ctrl']]
-                    if _ch['ctrl'] == 'g':
-                        color_inverter()
-            elif re.search('^[0-9]', _ch['ctrl']):
-                ch_out = _colors['ansi_wrap']['fg'].format(
-                                                        _colors[_ch['c'][0]])
-                if palette_map == 8:
-                    ch_out += 'm'
-            else:
-                # _ch['ctrl'] is not found and we don't have a color number
-                # to look up, so leave ch_out as ''
-                pass
-        return(ch_out)
-    #color_ptrn = re.compile('\x03[0-9]{1,2}(,[0-9]{1,2})?')
-    catch = re.compile('(\x03[0-9]{2}(,[0-9]{1, 2})?|'
-                       '\x04([a-h]|;/|>/|[0-9]/?))')
-    # These are some non-programmatic regexes.
-    # Clean up the nick.
-    nick_re = re.compile('(\x048/\s*)')
-    # mIRC uses a different tag for reset.
-    mirc_rst = re.compile('\x0f')
-    # mIRC and Irssi tags, respectively, for inversion.
-    re_invert = re.compile('(\x16|\x04d)')
-    data = data_in.splitlines()
-    for idx, line in enumerate(data[:]):
-        # Get some preliminary replacements out of the way.
-        line = nick_re.sub(' ', line, 1)
-        line = re_invert.sub(color_inverter, line)
-        line = mirc_rst.sub(reset_char, line)
-        # This is like 90% of the magic, honestly.
-        line = catch.sub(_repl, line)
-        if not line.endswith(reset_char):
-            line += reset_char
-        # Since we clear all formatting at the end of each line
-        is_inverted = False
-        data[idx] = line
-    return('\n'.join(data))
+            if fg is not None:
+                cls.append('fg{0}'.format(fg))
+            if bg is not None:
+                cls.append('bg{0}'.format(bg))
+        cls.extend(a for a in html_attrs if a != 'rev' and state[a])
+        return(' '.join(cls))
 
 def plain_stripper(data_in):
     # Strip to plaintext only.
-    data = data_in.splitlines()
-    ptrns = [re.compile('\x04(g|c|[389;]/?|e|>)/?'),
-             re.compile('((\x03)\d\d?,\d\d?|(\x03)\d\d?|[\x01-\x1F])')]
+    data = data_in.split('\n')
     for idx, line in enumerate(data[:]):
-        # This cleans the nick field
-        l = re.sub('\x04[89]/', ' ', line, 1)
-        # And these clean the actual chat messages
-        for p in ptrns:
-            l = p.sub('', l)
-        data[idx] = l
+        data[idx] = plain_strip_line(line)
     return('\n'.join(data))
 
+_plain_ptrns = [re.compile('\x04(g|c|[389;]/?|e|>)/?'),
+                re.compile('((\x03)\d\d?,\d\d?|(\x03)\d\d?|[\x01-\x1F])')]
+def plain_strip_line(line):
+    # This cleans the nick field
+    l = re.sub('\x04[89]/', ' ', line, 1)
+    # And these clean the actual chat messages
+    for p in _plain_ptrns:
+        l = p.sub('', l)
+    return(l)
+
+def color_setup(args):
+    # Make sure we can actually output color and figure out which palette to
+    # use. This goes through curses (which is slow and wants a terminal), so
+    # it's only done once; the palette is stored in args['palette'] and
+    # irssiLogParser won't check again if it's there.
+    if args.get('html') or not args.get('color'):
+        return(None)
+    # Ensure that we support color output.
+    curses.initscr()
+    args['color'] = curses.can_change_color()
+    curses.endwin()
+    if not args['color'] and not args['raw']:
+        raise RuntimeError('You have specified ANSI colorized '
+                           'output but your terminal does not '
+                           'support it. Use -fc/--force-color '
+                           'to force.')
+    elif not args['color'] and args['raw']:
+        args['color'] = True  # Force the output anyways.
+    if not args['raw']:
+        args['palette'] = get_palette()
+    else:
+        args['palette'] = 8  # Best play it safe for maximum compatibility.
+    return(args['palette'])
+
 class irssiLogParser(object):
     def __init__(self, args, data = None):
         # We'll need these accessible across the entire class.
         self.args = args
-        # If specified, self.data takes precedence over self.args['logfile']
+        # If specified, data takes precedence over self.args['logfile']
         # (if it was specified).
-        self.data = data
-        self.raw = data
+        # The log is never read into memory all at once; self.fh is a
+        # (decompressed, decoded) text stream and parser() works through it
+        # line by line.
+        self.fh = None
         self.has_html = False
         self.decompress = None
-        if 'color' in self.args and self.args['color']:
-            if not self.args['html']:
-                # Ensure that we support color output.
-                curses.initscr()
-                self.args['color'] = curses.can_change_color()
-                curses.endwin()
-                if not self.args['color'] and not self.args['raw']:
-                    raise RuntimeError('You have specified ANSI colorized '
-                                       'output but your terminal does not '
-                                       'support it. Use -fc/--force-color '
-                                       'to force.')
-                elif not self.args['color'] and self.args['raw']:
-                    self.args['color'] = True  # Force the output anyways.
-        if self.args['color']:
-            if not self.args['raw']:
-                self.colors = get_palette()
-            else:
-                self.colors = 8  # Best play it safe for maximum compatibility.
+        self.converter = None
+        if self.args.get('html'):
+            # No terminal involved, so no need to check for color support.
+            self.has_html = True
+            self.args['color'] = False
+            self.converter = HTMLConverter()
+        if self.args.get('color'):
+            # Batch mode works this out once, up front.
+            if not self.args.get('palette'):
+                color_setup(self.args)
+            self.colors = self.args['palette']
+            self.converter = ColorConverter(self.colors)
         # The full, interpreted path.
         if ('logfile' in self.args.keys() and
             self.args['logfile'] is not None):
             self.args['logfile'] = os.path.abspath(
                                         os.path.expanduser(
                                                 self.args['logfile']))
-        if not self.data:
+        if data is None or (isinstance(data, (bytes, str)) and not data):
             self.getlog()
+        elif hasattr(data, 'read'):
+            # A binary file object (e.g. a part of a log that's already
+            # open). decompressor() needs to be able to peek() at it.
+            self.fh = (data if hasattr(data, 'peek')
+                       else io.BufferedReader(data))
         else:
             # Conform everything to bytes.
-            if not isinstance(self.data, bytes):
-                self.data = self.data.encode('utf-8')
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.fh = io.BufferedReader(io.BytesIO(data))
         self.decompressor()
-        self.parser()
 
     def getlog(self):
         # A filepath was specified
@@ -336,17 +553,15 @@ class irssiLogParser(object):
             if not os.path.isfile(self.args['logfile']):
                 raise FileNotFoundError('{0} does not exist'.format(
                                                         self.args['logfile']))
-            with open(self.args['logfile'], 'rb') as f:
-                self.data = f.read()
+            self.fh = open(self.args['logfile'], 'rb')
         # Try to get it from stdin
         else:
             if not sys.stdin.isatty():
-                self.data = sys.stdin.buffer.read()
+                self.fh = sys.stdin.buffer
             else:
                 raise ValueError('Either a path to a logfile must be '
                                  'specified or you must pipe a log in from '
                                  'stdin.')
-        self.raw = self.data
         return()
 
     def decompressor(self):
@@ -354,33 +569,45 @@ class irssiLogParser(object):
         # https://docs.python.org/3/library/mimetypes.html
         # VERY less-than-ideal since it won't work without self.args['logfile']
         # (and has iffy detection at best, since it relies on file extensions).
-        # Determine what decompressor to use, if we need to.
+        # Determine what decompressor to use, if we need to. We only look at
+        # the first couple KB (peek() doesn't consume it, so this works for
+        # stdin too).
+        _head = self.fh.peek(2048)[:2048]
         if has_magic:
-            _mime = magic.detect_from_content(self.data).mime_type
-            self.decompress = cmprsn_map[_mime]
-            if self.decompress:
-                import importlib
-                decmp = importlib.import_module(self.decompress)
-                self.raw = decmp.decompress(self.data)
+            _mime = magic.detect_from_content(_head).mime_type
+            self.decompress = cmprsn_map.get(_mime)
         else:
-            # Assume that it's text and that it isn't compressed.
-            # We'll get a UnicodeDecodeError exception if it isn't.
-            pass
-        try:
-            self.raw = self.data.decode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        self.data = self.raw
+            for sig, mod in cmprsn_sigs.items():
+                if _head.startswith(sig):
+                    self.decompress = mod
+                    break
+        if self.decompress:
+            decmp = importlib.import_module(self.decompress)
+            self.fh = decmp.open(self.fh, 'rb')
+        # Irssi logs can have the odd bit of invalid UTF-8 in them (e.g. from
+        # other clients' encodings); don't choke on it.
+        self.fh = io.TextIOWrapper(self.fh,
+                                   encoding = 'utf-8',
+                                   errors = 'replace')
         return()
 
     def parser(self):
-        if 'color' not in self.args or not self.args['color']:
-            self.data = plain_stripper(self.data)
-        else:
-            self.data = color_converter(self.data, self.colors)
-        # Just in case...
-        self.data += '\x1b[0m'
-        return()
+        # A generator; yields each converted line of the log (without the
+        # trailing newline). Colorized (and HTML) logs are converted a block
+        # of lines at a time (much faster), which still keeps memory bounded.
+        if not self.converter:
+            for line in self.fh:
+                yield(plain_strip_line(line.rstrip('\n')))
+            return
+        while True:
+            block = ''.join(self.fh.readlines(1048576))
+            if not block:
+                break
+            if block.endswith('\n'):
+                block = block[:-1]
+            for line in self.converter.convert(block).split('\n'):
+                yield(line)
+        return
 
 def parseArgs():
     args = argparse.ArgumentParser()
@@ -401,35 +628,143 @@ def parseArgs():
     args.add_argument('-H', '--html',
                       dest = 'html',
                       action = 'store_true',
-                      help = ('Render HTML output (requires ansi2html)'))
-    args.add_argument(dest = 'logfile',
+                      help = ('Render HTML output instead (colors are '
+                              'mapped to CSS classes)'))
+    args.add_argument('-o', '--outdir',
+                      dest = 'outdir',
                       default = None,
-                      nargs = '?',
+                      help = ('Write each log to its own file in this '
+                              'directory (named after the log, with a .txt '
+                              'or .html extension) instead of stdout'))
+    args.add_argument('-w', '--workers',
+                      dest = 'workers',
+                      type = int,
+                      default = os.cpu_count(),
+                      help = ('If more than one log is given (or -o/--outdir '
+                              'is), the number of logs to process at once. '
+                              'Default is the number of CPUs ({0})').format(
+                                                            os.cpu_count()))
+    args.add_argument(dest = 'logfile',
+                      default = [],
+                      nargs = '*',
                       metavar = 'path/to/logfile',
                       help = ('The path to the log file. It can be uncompressed ' +
                               'or compressed with XZ/LZMA, Gzip, or Bzip2. '
-                              'If not specified, read from stdin'))
+                              'Any number of logs (or globs, e.g. '
+                              '"~/irclogs/*/#chan.*") can be given; they\'re '
+                              'output in the order given. If not specified, '
+                              'read from stdin'))
     return(args)
 
-if __name__ == '__main__':
+def write_log(l, out, title = 'IRC log'):
+    # Write a whole converted log (an irssiLogParser) to out, a text file
+    # object.
+    if l.has_html:
+        out.write(html_header(title))
+    for line in l.parser():
+        out.write(line + '\n')
+    if l.has_html:
+        out.write(html_footer)
+    elif l.args['color']:
+        # Just in case...
+        out.write('\x1b[0m')
+    return()
+
+def get_logfiles(paths):
+    # Globs are expanded here too, in case the shell didn't (e.g. they were
+    # quoted, or there are too many logs for one command line). Anything
+    # that doesn't match is passed through as-is so it errors out properly.
+    logfiles = []
+    for p in paths:
+        p = os.path.abspath(os.path.expanduser(p))
+        matches = sorted(glob.glob(p))
+        logfiles.extend(matches if matches else [p])
+    return(logfiles)
+
+def get_outname(logfile, html_out = False):
+    # e.g. #chan.2018-01-01.log.xz -> #chan.2018-01-01.log.html
+    name = os.path.basename(logfile)
+    base, ext = os.path.splitext(name)
+    if ext in ('.bz2', '.gz', '.xz'):
+        name = base
+    return(name + ('.html' if html_out else '.txt'))
+
+def _convert_file(args, logfile, outpath):
+    # Module-level so it can be pickled for a process pool.
+    l = irssiLogParser(dict(args, logfile = logfile))
+    try:
+        with open(outpath, 'w', encoding = 'utf-8') as fh:
+            write_log(l, fh, os.path.basename(logfile))
+    finally:
+        l.fh.close()
+    return(outpath)
+
+def batch(args, logfiles):
+    # Each log is converted by a worker process into its own file; either
+    # the final one (args['outdir']) or a temporary one that's copied to
+    # stdout and removed. Either way, they're handled in the order given and
+    # each log's output is kept together. Only a couple of logs per worker
+    # are in flight at once so we aren't sitting on a pile of temp files.
+    # Curses/palette detection is done once, here, and handed to the workers.
+    color_setup(args)
+    tmpdir = None
+    if args['outdir']:
+        outdir = os.path.abspath(os.path.expanduser(args['outdir']))
+        os.makedirs(outdir, exist_ok = True)
+        outpaths = [os.path.join(outdir, get_outname(f, args['html']))
+                    for f in logfiles]
+        _dupes = [i for i, c in collections.Counter(outpaths).items() if c > 1]
+        if _dupes:
+            raise ValueError(('More than one log would be written to: '
+                              '{0}').format(', '.join(_dupes)))
+    else:
+        if args['html']:
+            raise ValueError('HTML output for more than one log requires '
+                             '-o/--outdir')
+        tmpdir = tempfile.mkdtemp(prefix = '.irssilogparse.')
+        outpaths = [os.path.join(tmpdir, '{0:08d}'.format(idx))
+                    for idx in range(len(logfiles))]
+    workers = (args['workers'] if args['workers'] else os.cpu_count())
+    maxpending = workers * 2
+    pending = collections.deque()
+    def _finish(f):
+        outpath = f.result()
+        if not tmpdir:
+            print(outpath)
+            return()
+        with open(outpath, 'r', encoding = 'utf-8') as fh:
+            shutil.copyfileobj(fh, sys.stdout)
+        os.remove(outpath)
+        return()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                                        max_workers = workers) as executor:
+            for logfile, outpath in zip(logfiles, outpaths):
+                pending.append(executor.submit(_convert_file,
+                                               args,
+                                               logfile,
+                                               outpath))
+                if len(pending) >= maxpending:
+                    _finish(pending.popleft())
+            while pending:
+                _finish(pending.popleft())
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    return()
+
+def main():
     args = vars(parseArgs().parse_args())
+    logfiles = get_logfiles(args['logfile'])
+    if args['outdir'] or len(logfiles) > 1:
+        batch(args, logfiles)
+        return()
+    args['logfile'] = (logfiles[0] if logfiles else None)
     l = irssiLogParser(args)
-    import shutil
-    cols = shutil.get_terminal_size().columns
-    #print('ARGS:')
-    #pprint.pprint(l.args, width = cols)
-    # print('RAW')
-    # pprint.pprint(l.raw, width = cols)
-    # with open('/tmp/freenode.formatted', 'r') as f:
-    #     print(f.read())
-    #print('DATA')
-    #pprint.pprint(l.data, width = cols)
-    #print('DATA (REPR)')
-    #pprint.pprint(repr(l.data).split('\\n'))
-    print('DATA')
-    print(l.data)
-    with open('/tmp/log.raw', 'w') as f:
-        for line in repr(l.data).split('\\n'):
-            f.write(line + '\n')
-    # l.parseLog()
-    # print(l.data.decode('utf-8'))
+    write_log(l,
+              sys.stdout,
+              os.path.basename(args['logfile'] or 'IRC log'))
+    return()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import time
+##
+import irssilogparse
+
+
+# Times color conversion over a synthetic Irssi log, both a line at a time (how a caller with single lines would use
+# it) and a block at a time (how irssiLogParser.parser() uses it). Run it from a checkout of the revision you want to
+# compare so the numbers are apples to apples.
+
+def gen_log(lines, seed = 0):
+    rnd = random.Random(seed)
+    log = []
+    for i in range(lines):
+        fg = rnd.randint(0, 15)
+        bg = rnd.randint(0, 15)
+        ictrl = rnd.choice('abcdef')
+        log.append(('{0:02d}:{1:02d}:{2:02d} \x048/<\x04e nick{3}\x048/> hello \x0304red\x03 and '
+                    '\x03{4:02d},{5:02d}colors\x0f \x02bold\x02 \x04{6}irssi\x04g \x1d\x1fitalic underline\x1f\x1d '
+                    '{7}').format((i // 3600) % 24, (i // 60) % 60, i % 60, i % 50, fg, bg, ictrl, i))
+    return('\n'.join(log))
+
+def bench(data, palette, blocked):
+    conv = irssilogparse.ColorConverter(palette)
+    start = time.perf_counter()
+    if blocked:
+        conv.convert(data)
+    else:
+        for line in data.split('\n'):
+            conv.convert(line)
+    return(time.perf_counter() - start)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark Irssi log color conversion over a synthetic log.')
+    args.add_argument('-n', '--lines',
+                      dest = 'lines',
+                      type = int,
+                      default = 200000,
+                      help = 'The number of lines to put in the synthetic log. Default is 200000')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    data = gen_log(args['lines'])
+    size = len(data.encode('utf-8')) / 1048576
+    print('{0} lines, {1:.1f} MiB'.format(args['lines'], size))
+    for palette in (8, 256, 'truecolor'):
+        for blocked in (False, True):
+            elapsed = bench(data, palette, blocked)
+            print('{0:>9} {1:>5}: {2:6.2f}s ({3:6.1f} MiB/s)'.format(palette,
+                                                                    ('block' if blocked else 'line'),
+                                                                    elapsed,
+                                                                    size / elapsed))
+    return()
+
+if __name__ == '__main__':
+    main()
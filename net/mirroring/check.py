@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import csv
 import datetime
 import difflib
@@ -8,18 +10,134 @@ import hashlib
 import lzma
 import os
 import pickle
-from urllib.request import urlopen
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 
 # TODO: to avoid race conditions, we should probably simply ignore/remove
 # timestamps and just touch the cache file whenever checking.
 
+# The urls.csv field names (see urls.csv.spec).
+FNAMES = ('UUID', 'url', 'checksum', 'timestamp')
+
+class Fetcher(object):
+    # All of the fetching goes through here, so it can be limited per host:
+    # at most per_host connections to a host at once, and at least delay
+    # seconds between starting requests to it. It's shared by all of the
+    # websites being checked (from however many threads); the overall
+    # number of connections is capped by how many threads there are.
+    def __init__(self, per_host = 2, delay = 0.0, timeout = 30):
+        self.per_host = per_host
+        self.delay = delay
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def fetch(self, url, headers = None):
+        # Returns the status, the body (as-is, i.e. possibly still gzipped)
+        # and the headers. A 304 (for a conditional request) isn't an error;
+        # it just has an empty body.
+        sem, nexttime = self._host(urlparse(url).netloc)
+        with sem:
+            if self.delay:
+                with nexttime['lock']:
+                    now = time.monotonic()
+                    wait = nexttime['time'] - now
+                    nexttime['time'] = max(now, nexttime['time']) + self.delay
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                with urlopen(Request(url, headers = (headers if headers else {})),
+                             timeout = self.timeout) as _site:
+                    return((_site.status, _site.read(), _site.info()))
+            except HTTPError as e:
+                if e.code != 304:
+                    raise
+                return((304, b'', e.headers))
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (threading.BoundedSemaphore(self.per_host),
+                                    {'lock': threading.Lock(), 'time': 0.0})
+            return(self.hosts[host])
+
+class Cache(object):
+    # The cached pages, in an SQLite DB in the cache dir, by UUID: one row
+    # per page, so a page can be read or replaced on its own. The pages are
+    # compressed with zlib; they're small, and xz -9e (what the cache used to
+    # be) is very slow to write for very little gain on them.
+    # Entries are dicts with the page ('body'), its 'etag', 'last_modified'
+    # and 'size' (how many bytes it took to download). Pages cached the old
+    # way (one xz'd pickle per UUID) are still read, and removed once
+    # they're replaced.
+    # It's shared between threads, so the connection is only used under a
+    # lock; (de)compression is done outside it.
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok = True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, 'cache.sqlite'),
+                                  check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute(('CREATE TABLE IF NOT EXISTS pages ('
+                         'uuid TEXT PRIMARY KEY, '
+                         'body BLOB, '
+                         'etag TEXT, '
+                         'last_modified TEXT, '
+                         'size INTEGER)'))
+        self.db.commit()
+
+    def get(self, uuid):
+        # Returns None if it isn't cached.
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, last_modified, size FROM pages WHERE uuid = ?',
+                                  (uuid, )).fetchone()
+        if row:
+            return({'body': zlib.decompress(row[0]).decode('utf-8'),
+                    'etag': row[1],
+                    'last_modified': row[2],
+                    'size': row[3]})
+        _cachefile = os.path.join(self.cache_dir, uuid)
+        if os.path.isfile(_cachefile):
+            with lzma.open(_cachefile, mode = 'rb') as f:
+                _cached = pickle.load(f)
+            if isinstance(_cached, str):  # Before the ETag, etc. were cached
+                _cached = {'body': _cached}
+            return(_cached)
+        return(None)
+
+    def put(self, uuid, entry):
+        _body = zlib.compress(entry['body'].encode('utf-8'))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                            (uuid, _body, entry.get('etag'), entry.get('last_modified'), entry.get('size', 0)))
+            self.db.commit()
+        _cachefile = os.path.join(self.cache_dir, uuid)
+        if os.path.isfile(_cachefile):
+            os.remove(_cachefile)
+        return()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+        return()
+
 class website(object):
-    def __init__(self, args, csvline):
+    def __init__(self, args, csvline, fetcher = None, cache = None):
         # Field names
-        self.fnames = ('UUID', 'url', 'checksum', 'timestamp')
+        self.fnames = FNAMES
         self.args = args
+        self.fetcher = (fetcher if fetcher else Fetcher())
         self.parseCSV([csvline])
-        self.cache = args['cache_dir']
+        self.cache = (cache if cache else Cache(args['cache_dir']))
         self.cacheControl()
         self.remoteFetch()
         return
@@ -35,86 +153,234 @@ class website(object):
         return()
 
     def cacheControl(self):
-        os.makedirs(self.cache, exist_ok = True)
-        self.site = {}
-        _cachefile = os.path.join(self.cache, self.meta['UUID'])
-        if os.path.isfile(_cachefile):
-            with lzma.open(_cachefile, mode = 'rb') as f:
-                self.site['local'] = pickle.load(f)
-        else:
-            with urlopen(self.meta['url']) as _site,\
-                 lzma.open(_cachefile,
-                           mode = 'wb',
-                           check = lzma.CHECK_SHA256,
-                           preset = 9|lzma.PRESET_EXTREME) as f:
-                _data = _site.read().decode('utf-8')
-                pickle.dump(_data, f)
-                self.site['local'] = _data
-                self.meta['timestamp'] = str(int(datetime.datetime.now().timestamp()))
-                _hash = hashlib.sha256(self.site['local'].encode('utf-8'))
-                self.meta['checksum'] = str(_hash.hexdigest())
+        # Along with the page itself, the cache has its ETag and
+        # Last-Modified (for conditional requests) and how many bytes it took
+        # to download (so we know how much a 304 saved).
+        self.site = {'local': None,
+                     'etag': None,
+                     'last_modified': None,
+                     'size': 0}
+        _cached = self.cache.get(self.meta['UUID'])
+        if _cached:
+            self.site['local'] = _cached['body']
+            for k in ('etag', 'last_modified', 'size'):
+                self.site[k] = _cached.get(k, self.site[k])
+        return()
+
+    def cacheWrite(self):
+        self.cache.put(self.meta['UUID'],
+                       {'body': self.site['remote'],
+                        'etag': self.site['remote_etag'],
+                        'last_modified': self.site['remote_last_modified'],
+                        'size': self.site['remote_size']})
         return()
 
     def remoteFetch(self):
-        with urlopen(self.meta['url']) as _site:
-            self.site['remote'] = _site.read()
-            self.headers = dict(_site.info())
-        # Handle gzip encoding
-        if 'Content-Encoding' in self.headers.keys():
-            if self.headers['Content-Encoding'] == 'gzip':
-                from gzip import decompress
-                self.site['remote'] = decompress(self.site['remote']).decode('utf-8')
+        # If we have the page cached, only ask for it if it's changed. The
+        # page is only ever fetched this once; compare() works from it.
+        _headers = {}
+        if self.site['local'] is not None:
+            if self.site['etag']:
+                _headers['If-None-Match'] = self.site['etag']
+            if self.site['last_modified']:
+                _headers['If-Modified-Since'] = self.site['last_modified']
+        _status, _body, self.headers = self.fetcher.fetch(self.meta['url'], headers = _headers)
+        self.status = _status
+        self.fetched = len(_body)
+        self.saved = 0
+        # A 304 doesn't have to repeat the ETag/Last-Modified.
+        self.site['remote_etag'] = self.headers.get('ETag', self.site['etag'])
+        self.site['remote_last_modified'] = self.headers.get('Last-Modified', self.site['last_modified'])
+        if _status == 304:
+            self.site['remote'] = self.site['local']
+            self.site['remote_size'] = self.site['size']
+            self.saved = self.site['size']
         else:
-            self.site['remote'] = self.site['remote'].decode('utf-8')
+            self.site['remote_size'] = len(_body)
+            # Handle gzip encoding
+            if self.headers.get('Content-Encoding') == 'gzip':
+                from gzip import decompress
+                _body = decompress(_body)
+            self.site['remote'] = _body.decode('utf-8')
         _hash = hashlib.sha256(self.site['remote'].encode('utf-8'))
         self.site['remotesum'] = str(_hash.hexdigest())
         self.meta['timestamp'] = str(int(datetime.datetime.now().timestamp()))
+        if self.site['local'] is None:
+            # First time; there's nothing to compare to yet.
+            self.site['local'] = self.site['remote']
+            self.meta['checksum'] = self.site['remotesum']
+            self.site['etag'] = self.site['remote_etag']
+            self.site['last_modified'] = self.site['remote_last_modified']
+            self.cacheWrite()
         return()
 
     def compare(self):
+        # This can run in a worker thread, so it doesn't print anything
+        # itself; see checkSites().
         # Don't even compare if the checksums match.
         if self.site['remotesum'] == self.meta['checksum']:
             self.diff = None
             #print('{0}: Doing nothing'.format(self.meta['UUID']))
+            if ((self.site['remote_etag'], self.site['remote_last_modified']) !=
+                    (self.site['etag'], self.site['last_modified'])):
+                self.cacheWrite()  # So the next request can be conditional.
             return()
-        print('{{{0}}}: "{1}":'.format(self.meta['UUID'], self.meta['url']))
         diff = difflib.unified_diff(self.site['local'].splitlines(1),
                                     self.site['remote'].splitlines(1))
         self.diff = ''.join(diff)
-        print(self.diff)
-        with urlopen(self.meta['url']) as _site,\
-                 lzma.open(os.path.join(self.cache, self.meta['UUID']),
-                           mode = 'wb',
-                           check = lzma.CHECK_SHA256,
-                           preset = 9|lzma.PRESET_EXTREME) as f:
-                _data = _site.read().decode('utf-8')
-                pickle.dump(_data, f)
+        self.cacheWrite()
         return()
 
-    def writeCSV(self):
+    def updateCSV(self, rows):
+        # rows is every row in the CSV, by UUID (see readCSV()); they get
+        # written out by writeCSV().
         #if self.diff:  # We actually WANT to write, because we're updating the last fetch timestamp.
-        _lines = []
-        with open(self.args['urls_csv'], 'r') as f:
-            _f = f.read()
-        _rows = csv.DictReader(_f.splitlines(),
-                               fieldnames = self.fnames,
-                               delimiter = ',',
-                               quotechar = '"')
-        for r in _rows:
-            _uuid = r['UUID']
-            if _uuid == self.meta['UUID']:
-                r['checksum'] = self.site['remotesum']
-                r['timestamp'] = self.meta['timestamp']
-            _lines.append(r)
-        with open(self.args['urls_csv'], 'w', newline = '') as f:
-            _w = csv.DictWriter(f,
-                                fieldnames = self.fnames,
-                                delimiter = ',',
-                                quotechar = '"',
-                                quoting = csv.QUOTE_ALL)
-            _w.writerows(_lines)
+        for r in rows.get(self.meta['UUID'], ()):
+            r['checksum'] = self.site['remotesum']
+            r['timestamp'] = self.meta['timestamp']
         return()
 
+def readCSV(fpath):
+    # Returns each (non-blank) line and its parsed row, and the rows by
+    # UUID. The rows are the same dicts in both, so updating one (i.e.
+    # website.updateCSV()) updates what writeCSV() writes.
+    with open(fpath, 'r', newline = '') as f:
+        _csv = f.read()
+    lines = []
+    rows = collections.OrderedDict()
+    for line in _csv.splitlines():
+        if not line.strip():
+            continue
+        for r in csv.DictReader([line],
+                                fieldnames = FNAMES,
+                                delimiter = ',',
+                                quotechar = '"'):
+            lines.append((line, r))
+            rows.setdefault(r['UUID'], []).append(r)
+    return(lines, rows)
+
+def writeCSV(fpath, lines):
+    # Write the whole CSV at once, to a temporary file that then replaces the
+    # real one, so it's never half-written (even if we're killed partway).
+    tmpfile = os.path.join(os.path.dirname(fpath),
+                           '.{0}.tmp'.format(os.path.basename(fpath)))
+    with open(tmpfile, 'w', newline = '') as f:
+        _w = csv.DictWriter(f,
+                            fieldnames = FNAMES,
+                            delimiter = ',',
+                            quotechar = '"',
+                            quoting = csv.QUOTE_ALL)
+        _w.writerows(r for line, r in lines)
+    if os.path.isfile(fpath):
+        shutil.copymode(fpath, tmpfile)
+    os.replace(tmpfile, fpath)
+    return()
+
+def checkSite(args, line, fetcher, cache):
+    w = website(args, line, fetcher, cache)
+    w.compare()
+    return(w)
+
+def checkSites(args, fetcher = None):
+    # The sites are checked args['workers'] at a time. They're queued up
+    # round-robin by host so that a long run of URLs on one host doesn't tie
+    # up every worker waiting on that host's limit. Results are handled here
+    # (in the main thread) as they come in, so the output doesn't get mixed
+    # up and the CSV is only written by one thing at a time.
+    # The CSV is read once, and the results are written back to it every
+    # args['save_interval'] seconds (if it's set) and at the end (even if
+    # something goes wrong).
+    if not fetcher:
+        fetcher = Fetcher(per_host = args['per_host'],
+                          delay = args['delay'],
+                          timeout = args['timeout'])
+    cache = Cache(args['cache_dir'])
+    csvlines, rows = readCSV(args['urls_csv'])
+    hosts = collections.OrderedDict()
+    for line, r in csvlines:
+        _host = (urlparse(r['url']).netloc if r['url'] else None)
+        hosts.setdefault(_host, collections.deque()).append(line)
+    lines = []
+    while hosts:
+        for _host in list(hosts):
+            lines.append(hosts[_host].popleft())
+            if not hosts[_host]:
+                del hosts[_host]
+    stats = {'checked': 0, 'notmodified': 0, 'fetched': 0, 'saved': 0}
+    interval = args.get('save_interval')
+    lastsave = time.monotonic()
+    unsaved = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                                max_workers = args['workers']) as executor:
+            # Only a couple of URLs per worker are queued up at a time, so if
+            # we're interrupted (or something else goes wrong) the pool
+            # doesn't have the rest of the list to get through before it
+            # shuts down; whatever is still queued is cancelled.
+            maxpending = args['workers'] * 2
+            todo = iter(lines)
+            futures = {}
+            try:
+                while True:
+                    for line in todo:
+                        futures[executor.submit(checkSite,
+                                                args,
+                                                line,
+                                                fetcher,
+                                                cache)] = line
+                        if len(futures) >= maxpending:
+                            break
+                    if not futures:
+                        break
+                    done, _ = concurrent.futures.wait(
+                            futures,
+                            return_when = concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        line = futures.pop(future)
+                        try:
+                            w = future.result()
+                        except Exception as e:
+                            # One bad URL shouldn't stop the rest from being
+                            # checked.
+                            print('ERROR: {0}: {1}'.format(line, e),
+                                  file = sys.stderr)
+                            continue
+                        stats['checked'] += 1
+                        stats['fetched'] += w.fetched
+                        stats['saved'] += w.saved
+                        if w.status == 304:
+                            stats['notmodified'] += 1
+                        w.updateCSV(rows)
+                        unsaved = True
+                        if w.diff:
+                            print('{{{0}}}: "{1}":'.format(w.meta['UUID'],
+                                                          w.meta['url']))
+                            print(w.diff)
+                        if (interval and
+                                time.monotonic() - lastsave >= interval):
+                            writeCSV(args['urls_csv'], csvlines)
+                            lastsave = time.monotonic()
+                            unsaved = False
+            except BaseException:
+                executor.shutdown(wait = False, cancel_futures = True)
+                # Save what we've got now, rather than after the checks that
+                # are still running (up to args['timeout'] each) are done.
+                if unsaved:
+                    writeCSV(args['urls_csv'], csvlines)
+                    unsaved = False
+                raise
+    finally:
+        if unsaved:
+            writeCSV(args['urls_csv'], csvlines)
+        cache.close()
+    if args.get('stats'):
+        print(('Checked {0} URLs ({1} not modified): downloaded {2} bytes, '
+               'saved {3} bytes with conditional requests').format(stats['checked'],
+                                                                   stats['notmodified'],
+                                                                   stats['fetched'],
+                                                                   stats['saved']))
+    return(stats)
+
 def parseArgs():
     # Define defaults
     _self_dir = os.path.dirname(os.path.realpath(__file__))
@@ -128,7 +394,7 @@ def parseArgs():
                       dest = 'cache_dir',
                       type = str,
                       help = ('The path to where cached versions of websites are stored. ' +
-                              'They are stored in the python binary "pickle" format. ' +
+                              'They are stored in an SQLite database (cache.sqlite) in it. ' +
                               'Default: \n\n\t\033[1m{0}\033[0m').format(_cache_dir))
     args.add_argument('-u',
                       '--urls',
@@ -140,20 +406,51 @@ def parseArgs():
                               'Note that it should be writeable by whatever user the script is running as.' +
                               'See urls.csv.spec for the specification. ' +
                               'Default: \n\n\t\033[1m{0}\033[0m').format(_urls_csv))
+    args.add_argument('-w',
+                      '--workers',
+                      default = 16,
+                      dest = 'workers',
+                      type = int,
+                      help = ('How many URLs to check at once (i.e. the most connections that will be open at ' +
+                              'once). Default: 16'))
+    args.add_argument('-p',
+                      '--per-host',
+                      default = 2,
+                      dest = 'per_host',
+                      type = int,
+                      help = 'The most connections to open to any one host at once. Default: 2')
+    args.add_argument('-d',
+                      '--delay',
+                      default = 0.0,
+                      dest = 'delay',
+                      type = float,
+                      help = 'How many seconds to wait between starting requests to the same host. Default: 0')
+    args.add_argument('-t',
+                      '--timeout',
+                      default = 30,
+                      dest = 'timeout',
+                      type = float,
+                      help = 'How many seconds to wait for a site to respond. Default: 30')
+    args.add_argument('-i',
+                      '--save-interval',
+                      default = 60,
+                      dest = 'save_interval',
+                      type = float,
+                      help = ('How often (in seconds) to save progress to the CSV while checking. It\'s always ' +
+                              'saved at the end. 0 means only at the end. Default: 60'))
+    args.add_argument('-s',
+                      '--stats',
+                      dest = 'stats',
+                      action = 'store_true',
+                      help = ('Print how many bytes were downloaded, and how many were saved by conditional ' +
+                              'requests (i.e. pages that weren\'t modified), at the end.'))
     return(args)
 
 def main():
     args = vars(parseArgs().parse_args())
     for d in ('cache_dir', 'urls_csv'):
         args[d] = os.path.realpath(os.path.expanduser(args[d]))
-    with open(args['urls_csv'], 'r', newline = '') as f:
-        _csv = f.read()
-    for line in _csv.splitlines():
-        w = website(args, line)
-        w.compare()
-        w.writeCSV()
-        if w.diff:
-            print(w.diff)
+    checkSites(args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import csv
+import email.utils
+import hashlib
+import io
+import lzma
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+##
+import check
+
+
+# Runs check.checkSites() against local HTTP servers serving thousands of pages, serially (one worker, one connection
+# per host) and concurrently. There's one server per host (127.0.0.1, 127.0.0.2, ...; all of 127/8 is loopback on
+# Linux), each adding some latency to every response like a real (remote) server would. The servers also keep track
+# of how many requests they had going at once, to show the per-host limit holds.
+# The cache is filled first, so the timed runs are "nothing changed" checks, except for the pages changed with
+# -m/--modified. The servers send an ETag and Last-Modified (and answer conditional requests with a 304) unless
+# -C/--no-conditional is given.
+# With -S/--storage, it instead times just the bookkeeping in urls.csv for each checked page, the old way (reading and
+# rewriting the whole CSV for every row) and the new (check.readCSV(), website.updateCSV() for each row and
+# check.writeCSV()), for increasingly many rows. The old way is only run up to -O/--old-max rows.
+# With -K/--cache, it times saving and then loading -n/--pages pages with check.Cache and the old way (an xz -9e'd
+# pickle per page).
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.active += 1
+            srv.peak = max(srv.peak, srv.active)
+        time.sleep(srv.latency)
+        # Every modified'th page changes from one run to the next.
+        page = int(self.path.rsplit('/', 1)[-1])
+        gen = (srv.generation if srv.modified and page % srv.modified == 0 else 0)
+        body = ('<html><body><h1>{0}</h1>{1}<p>{2}</p></body></html>\n'.format(self.path,
+                                                                              'Lorem ipsum dolor sit amet. ' * 100,
+                                                                              gen))
+        body = body.encode('utf-8')
+        etag = '"{0}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        # Before the body goes out, since the client can start its next request as soon as it has it.
+        with srv.lock:
+            srv.active -= 1
+        if srv.conditional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if srv.conditional:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(srv.started + gen, usegmt = True))
+        self.end_headers()
+        self.wfile.write(body)
+        with srv.lock:
+            srv.sent += len(body)
+        return()
+
+    def log_message(self, *args):
+        return()
+
+def start_servers(hosts, latency, conditional = True, modified = 0):
+    servers = []
+    for i in range(hosts):
+        srv = ThreadingHTTPServer(('127.0.0.{0}'.format(i + 1), 0), Handler)
+        srv.daemon_threads = True
+        srv.latency = latency
+        srv.conditional = conditional
+        srv.modified = modified
+        srv.generation = 0
+        srv.started = int(time.time())
+        srv.sent = 0
+        srv.lock = threading.Lock()
+        srv.active = 0
+        srv.peak = 0
+        threading.Thread(target = srv.serve_forever, daemon = True).start()
+        servers.append(srv)
+    return(servers)
+
+def gen_csv(fpath, servers, pages):
+    with open(fpath, 'w', newline = '') as f:
+        w = csv.writer(f, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_ALL)
+        for i in range(pages):
+            srv = servers[i % len(servers)]
+            w.writerow(['page{0}'.format(i),
+                        'http://{0}:{1}/page/{2}'.format(srv.server_address[0], srv.server_address[1], i),
+                        '',
+                        ''])
+    return()
+
+def old_update(fpath, uuid, checksum, timestamp):
+    # What website.writeCSV() used to do for every row.
+    _lines = []
+    with open(fpath, 'r') as f:
+        _f = f.read()
+    for r in csv.DictReader(_f.splitlines(), fieldnames = check.FNAMES, delimiter = ',', quotechar = '"'):
+        if r['UUID'] == uuid:
+            r['checksum'] = checksum
+            r['timestamp'] = timestamp
+        _lines.append(r)
+    with open(fpath, 'w', newline = '') as f:
+        _w = csv.DictWriter(f, fieldnames = check.FNAMES, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_ALL)
+        _w.writerows(_lines)
+    return()
+
+def new_update(fpath, uuids, checksum, timestamp):
+    csvlines, rows = check.readCSV(fpath)
+    w = check.website.__new__(check.website)
+    w.site = {'remotesum': checksum}
+    for uuid in uuids:
+        w.meta = {'UUID': uuid, 'timestamp': timestamp}
+        w.updateCSV(rows)
+    check.writeCSV(fpath, csvlines)
+    return()
+
+def storage(args, workdir):
+    fpath = os.path.join(workdir, 'urls.csv')
+    checksum = hashlib.sha256(b'').hexdigest()
+    timestamp = str(int(time.time()))
+    for n in (1000, 10000, 100000):
+        uuids = ['{0:08x}-0000-4000-8000-{1:012x}'.format(i, i) for i in range(n)]
+        results = []
+        for name, func in (('old', old_update), ('new', new_update)):
+            if name == 'old' and n > args['old_max']:
+                results.append('{0:>12}'.format('(skipped)'))
+                continue
+            with open(fpath, 'w', newline = '') as f:
+                w = csv.writer(f, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_ALL)
+                for uuid in uuids:
+                    w.writerow([uuid, 'https://www.example.com/{0}'.format(uuid), '', ''])
+            start = time.perf_counter()
+            if name == 'old':
+                for uuid in uuids:
+                    func(fpath, uuid, checksum, timestamp)
+            else:
+                func(fpath, uuids, checksum, timestamp)
+            results.append('{0:11.3f}s'.format(time.perf_counter() - start))
+        print('{0:>7} rows: old {1}, new {2}'.format(n, *results))
+    return()
+
+def gen_page(rnd, i):
+    words = ('mirror', 'sync', 'rsync', 'http', 'iso', 'release', 'package', 'updated', 'status', 'checksum',
+             'sha256', 'signature', 'tier', 'bandwidth', 'latency', 'arch', 'x86_64', 'aarch64', 'stable', 'testing')
+    paras = []
+    for p in range(rnd.randint(10, 40)):
+        paras.append('<p>{0}</p>'.format(' '.join(rnd.choice(words) for w in range(rnd.randint(20, 60)))))
+    return('<html><head><title>Page {0}</title></head><body>\n{1}\n</body></html>\n'.format(i, '\n'.join(paras)))
+
+def old_save(cache_dir, uuid, entry):
+    with lzma.open(os.path.join(cache_dir, uuid), mode = 'wb', check = lzma.CHECK_SHA256,
+                   preset = 9|lzma.PRESET_EXTREME) as f:
+        pickle.dump(entry, f)
+    return()
+
+def old_load(cache_dir, uuid):
+    with lzma.open(os.path.join(cache_dir, uuid), mode = 'rb') as f:
+        return(pickle.load(f))
+
+def cache(args, workdir):
+    rnd = random.Random(0)
+    pages = [('page{0}'.format(i), {'body': gen_page(rnd, i), 'etag': '"{0}"'.format(i), 'last_modified': None,
+                                    'size': 0})
+             for i in range(args['pages'])]
+    size = sum(len(e['body']) for u, e in pages)
+    print('{0} pages, {1} bytes'.format(len(pages), size))
+    for name in ('old', 'new'):
+        cache_dir = os.path.join(workdir, name)
+        os.makedirs(cache_dir)
+        c = check.Cache(cache_dir)
+        if name == 'old':
+            save, load = (lambda u, e: old_save(cache_dir, u, e)), (lambda u: old_load(cache_dir, u))
+        else:
+            save, load = c.put, c.get
+        start = time.perf_counter()
+        for uuid, entry in pages:
+            save(uuid, entry)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        for uuid, entry in pages:
+            assert load(uuid)['body'] == entry['body']
+        loaded = time.perf_counter() - start
+        c.close()
+        disk = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+        print('{0}: save {1:8.2f}s ({2:6.2f} ms/page), load {3:6.2f}s ({4:6.2f} ms/page), {5} bytes on disk'.format(
+                                                                                        name,
+                                                                                        saved,
+                                                                                        saved / len(pages) * 1000,
+                                                                                        loaded,
+                                                                                        loaded / len(pages) * 1000,
+                                                                                        disk))
+    return()
+
+def run(args, workdir, workers, per_host):
+    for srv in args['servers']:
+        srv.peak = 0
+        srv.sent = 0
+        srv.generation += 1
+    cargs = {'cache_dir': os.path.join(workdir, 'cache'),
+             'urls_csv': os.path.join(workdir, 'urls.csv'),
+             'workers': workers,
+             'per_host': per_host,
+             'delay': 0.0,
+             'timeout': 30}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        check.checkSites(cargs)
+    return(time.perf_counter() - start,
+           max(srv.peak for srv in args['servers']),
+           sum(srv.sent for srv in args['servers']))
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark check.py against local HTTP servers.')
+    args.add_argument('-n', '--pages',
+                      dest = 'pages',
+                      type = int,
+                      default = 2000,
+                      help = 'How many pages (URLs) to check. Default is 2000')
+    args.add_argument('-H', '--hosts',
+                      dest = 'hosts',
+                      type = int,
+                      default = 8,
+                      help = 'How many hosts to spread them over. Default is 8')
+    args.add_argument('-l', '--latency',
+                      dest = 'latency',
+                      type = float,
+                      default = 0.05,
+                      help = 'How long each response takes, in seconds. Default is 0.05')
+    args.add_argument('-w', '--workers',
+                      dest = 'workers',
+                      type = int,
+                      default = 32,
+                      help = 'How many workers for the concurrent run. Default is 32')
+    args.add_argument('-p', '--per-host',
+                      dest = 'per_host',
+                      type = int,
+                      default = 4,
+                      help = 'The per-host connection limit for the concurrent run. Default is 4')
+    args.add_argument('-m', '--modified',
+                      dest = 'modified',
+                      type = float,
+                      default = 0.01,
+                      help = 'The fraction of pages that change between runs. Default is 0.01')
+    args.add_argument('-C', '--no-conditional',
+                      dest = 'conditional',
+                      action = 'store_false',
+                      help = 'Don\'t send ETag or Last-Modified (i.e. every check downloads every page)')
+    args.add_argument('-S', '--storage',
+                      dest = 'storage',
+                      action = 'store_true',
+                      help = 'Time the CSV bookkeeping instead, for 1000 to 100000 rows')
+    args.add_argument('-K', '--cache',
+                      dest = 'cache',
+                      action = 'store_true',
+                      help = 'Time saving and loading -n/--pages pages in the cache instead')
+    args.add_argument('-O', '--old-max',
+                      dest = 'old_max',
+                      type = int,
+                      default = 1000,
+                      help = '(-S) The most rows to time the old way with (it\'s quadratic). Default is 1000')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    if args['storage'] or args['cache']:
+        workdir = tempfile.mkdtemp(prefix = '.check_bench.')
+        try:
+            if args['storage']:
+                storage(args, workdir)
+            else:
+                cache(args, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        return()
+    args['servers'] = start_servers(args['hosts'],
+                                    args['latency'],
+                                    conditional = args['conditional'],
+                                    modified = (int(1 / args['modified']) if args['modified'] else 0))
+    workdir = tempfile.mkdtemp(prefix = '.check_bench.')
+    try:
+        gen_csv(os.path.join(workdir, 'urls.csv'), args['servers'], args['pages'])
+        print('{0} pages on {1} hosts, {2:.0f}ms per response'.format(args['pages'],
+                                                                     args['hosts'],
+                                                                     args['latency'] * 1000))
+        elapsed, peak, sent = run(args, workdir, args['workers'], args['per_host'])
+        print('{0:>32}: {1:7.2f}s, {2:10d} bytes sent'.format('(filling the cache)', elapsed, sent))
+        for name, workers, per_host in (('serial', 1, 1),
+                                        ('{0} workers, {1} per host'.format(args['workers'], args['per_host']),
+                                         args['workers'],
+                                         args['per_host'])):
+            elapsed, peak, sent = run(args, workdir, workers, per_host)
+            print(('{0:>32}: {1:7.2f}s ({2:7.1f} pages/s), {3:10d} bytes sent, '
+                   'at most {4} at once on a host').format(name, elapsed, args['pages'] / elapsed, sent, peak))
+    finally:
+        shutil.rmtree(workdir)
+    return()
+
+if __name__ == '__main__':
+    main()
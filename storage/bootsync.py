@@ -9,6 +9,7 @@ import platform
 import psutil
 import re
 import shutil
+import struct
 import subprocess
 
 # The device:mountpoint of the mounts for the failover partitions.
@@ -43,12 +44,44 @@ grub = {'themes': {'orig': '/usr/share/grub/themes',
 # You need to have grub's config set to use UUIDs.
 ###############################################################################
 
+def get_file_hash(fpath, bufsize = 1048576):
+    # Streams the file through sha512 in bufsize chunks instead of reading it
+    # all into memory (the ISOs can be several GB).
+    fpath = os.path.abspath(os.path.expanduser(fpath))
+    _hash = hashlib.sha512()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(fpath, 'rb') as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            _hash.update(view[:n])
+    return(_hash.hexdigest())
+
 def get_file_kernel_ver(kpath):
     # Gets the version of a kernel file.
     kpath = os.path.abspath(os.path.expanduser(kpath))
     _kinfo = {}
     with open(kpath, 'rb') as f:
-        _m = magic.detect_from_content(f.read())
+        # Try the x86 boot protocol header first; it's only a few hundred
+        # bytes instead of the whole image.
+        # https://www.kernel.org/doc/html/latest/x86/boot.html
+        # 0x202 is the "HdrS" magic, 0x206 the boot protocol version, and
+        # 0x20e points to the version string (relative to 0x200).
+        _hdr = f.read(0x210)
+        if len(_hdr) == 0x210 and _hdr[0x202:0x206] == b'HdrS':
+            _proto, = struct.unpack_from('<H', _hdr, 0x206)
+            _ptr, = struct.unpack_from('<H', _hdr, 0x20e)
+            if _proto >= 0x0200 and _ptr:
+                f.seek(_ptr + 0x200)
+                _ver = f.read(256).split(b'\x00', 1)[0].decode('utf-8',
+                                                               'replace')
+                if _ver.strip():
+                    return(_ver.split()[0])
+        # Otherwise fall back to libmagic. It doesn't look past the first MiB.
+        f.seek(0)
+        _m = magic.detect_from_content(f.read(1048576))
     for i in _m.name.split(','):
         l = i.strip().split()
         # Note: this only grabs the version number.
@@ -87,6 +120,9 @@ class BootSync(object):
         self.installed_kern_ver = get_file_kernel_ver('/boot/vmlinuz-linux')
         self.reboot = False  # If a reboot is needed (WARN, don't execute!)
         self.syncs = {}
+        # Hashes of the canonical source files; each is only read once per
+        # run no matter how many mounts it gets compared against.
+        self.src_hashes = {}
         self.blkids = {}
         self.dummy_uuid = None
         self.chk_reboot()
@@ -143,21 +179,21 @@ class BootSync(object):
                             )['filesystems'][0]['source']]
         return()
 
+    def get_src_hash(self, fpath):
+        fpath = os.path.abspath(os.path.expanduser(fpath))
+        if fpath not in self.src_hashes:
+            self.src_hashes[fpath] = get_file_hash(fpath)
+        return(self.src_hashes[fpath])
+
     def get_hashes(self):
-        def _get_hash(fpath):
-            fpath = os.path.abspath(os.path.expanduser(fpath))
-            _hash = hashlib.sha512()
-            with open(fpath, 'rb') as fh:
-                _hash.update(fh.read())
-            return(_hash.hexdigest())
         for f in files:
             # We do /boot files manually in case it isn't specified as a
             # separate mount.
             fpath = os.path.join('/boot', f)
-            canon_hash = _get_hash(fpath)
+            canon_hash = self.get_src_hash(fpath)
             for m in mounts:
                 fpath = os.path.join(mounts[m], f)
-                file_hash = _get_hash(fpath)
+                file_hash = get_file_hash(fpath)
                 if file_hash != canon_hash:
                     if f not in self.syncs:
                         self.syncs[f] = []
@@ -199,8 +235,7 @@ class BootSync(object):
             for f in _fnames:
                 origfile = os.path.join(grub[g]['orig'], f)
                 destfile = os.path.join(grub[g]['dest'], f)
-                with open(origfile, 'rb') as f:
-                    _orig = hashlib.sha512(f.read()).hexdigest()
+                _orig = self.get_src_hash(origfile)
                 for m in _mounts:
                     real_destfile = os.path.join(m, destfile)
                     if not os.path.isfile(real_destfile):
@@ -208,8 +243,7 @@ class BootSync(object):
                                     exist_ok = True)
                         shutil.copy2(origfile, real_destfile)
                     else:
-                        with open(real_destfile, 'rb') as f:
-                            _dest = hashlib.sha512(f.read()).hexdigest()
+                        _dest = get_file_hash(real_destfile)
                         if _orig != _dest:
                             shutil.copy2(origfile, real_destfile)
         return()
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import copy
 import datetime
+import hashlib
+import io
+import itertools
 import os
 import pathlib
+import posixpath
 import re
+import stat
 import sys
 import lxml.etree
 
@@ -15,20 +22,108 @@ import lxml.etree
 
 # TODO: use bitwise operations to convert octal modes back and forth. ex. at https://stackoverflow.com/a/1746850
 
+# The mtree keyword -> hashlib name for the digests we can verify.
+_hashtypes = {'md5': 'md5',
+              'rmd160': 'ripemd160',
+              'sha1': 'sha1',
+              'sha256': 'sha256',
+              'sha384': 'sha384',
+              'sha512': 'sha512'}
+# stat.S_IS* test -> mtree type.
+_stattypes = ((stat.S_ISREG, 'file'),
+              (stat.S_ISDIR, 'dir'),
+              (stat.S_ISLNK, 'link'),
+              (stat.S_ISBLK, 'block'),
+              (stat.S_ISCHR, 'char'),
+              (stat.S_ISFIFO, 'fifo'),
+              (stat.S_ISSOCK, 'socket'))
+
+
+class Cksum(object):
+    # The POSIX cksum(1) CRC (see the notes on the "cksum" keyword in MtreeXML), with a hashlib-like interface
+    # so it can be fed alongside the real digests. It's pure python, so it's MUCH slower than the hashlib ones;
+    # it only gets used if the spec actually has cksum keywords.
+    _table = []
+    for _i in range(256):
+        _c = _i << 24
+        for _j in range(8):
+            _c = ((_c << 1) ^ 0x04c11db7) if _c & 0x80000000 else (_c << 1)
+        _table.append(_c & 0xffffffff)
+    del(_i, _j, _c)
+
+    def __init__(self):
+        self.crc = 0
+        self.length = 0
+
+    def update(self, data):
+        crc = self.crc
+        table = self._table
+        for b in bytes(data):
+            crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ b]
+        self.crc = crc
+        self.length += len(data)
+        return()
+
+    def digest(self):
+        crc = self.crc
+        table = self._table
+        length = self.length
+        while length:
+            crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ (length & 0xff)]
+            length >>= 8
+        return(~crc & 0xffffffff)
+
+
+def mtime_parse(spectime):
+    # Splits an mtree time (e.g. "1523445642.123456789") into integer seconds and the fractional part as written,
+    # along with how many digits it has (at most 9, i.e. nanoseconds).
+    sec, _, frac = spectime.partition('.')
+    frac = frac[:9]
+    return(int(sec), (int(frac) if frac else 0), len(frac))
+
+def digest_file(fpath, hashtypes, bufsize = 1048576):
+    # Reads fpath exactly once, feeding each chunk to every requested digest. hashtypes are mtree keywords
+    # ('cksum', 'md5', 'rmd160', 'sha1', 'sha256', 'sha384', 'sha512'). This is a module-level function so it can be
+    # pickled for a process pool.
+    hashers = {}
+    for h in hashtypes:
+        if h == 'cksum':
+            hashers[h] = Cksum()
+        else:
+            hashers[h] = hashlib.new(_hashtypes[h])
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(fpath, 'rb') as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            for h in hashers.values():
+                h.update(view[:n])
+    out = {}
+    for k, h in hashers.items():
+        out[k] = (h.digest() if k == 'cksum' else h.hexdigest())
+    return(out)
+
 class MtreeXML(object):
-    def __init__(self, spec):
-        # spec is a string or bytes
-        if not isinstance(spec, (str, bytes)):
-            raise ValueError('spec must be a raw string of the spec or a bytes object of the string')
-        if isinstance(spec, bytes):
-            try:
-                spec = spec.decode('utf-8')
-            except UnicodeDecodeError:
-                raise ValueError('spec must be a utf-8 encoded set of bytes if using byte mode')
+    def __init__(self, spec, stream = False):
+        # spec is a string, bytes, or a file object (text or binary) opened for reading (e.g. sys.stdin).
+        # If stream is True, the items are NOT collected into self._spec['paths']; instead, iterate over
+        # self.items() to get them one at a time (this keeps memory usage flat regardless of spec size).
         self._strptime_fmt = '%a %b %d %H:%M:%S %Y'
-        self.orig_spec = copy.deepcopy(spec)  # For referencing in case someone wanted to write it out.
-        # We NOW need to handle the escaped linebreaking it does.
-        self._specdata = re.sub('\\\\\s+', '', spec).splitlines()
+        self.orig_spec = None
+        if isinstance(spec, (str, bytes)):
+            if isinstance(spec, bytes):
+                try:
+                    spec = spec.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError('spec must be a utf-8 encoded set of bytes if using byte mode')
+            self.orig_spec = copy.deepcopy(spec)  # For referencing in case someone wanted to write it out.
+            spec = io.StringIO(spec)
+        elif not hasattr(spec, 'readline'):
+            raise ValueError(('spec must be a raw string of the spec, a bytes object of the string, '
+                              'or a file object of the spec'))
+        self._specdata = self._read_lines(spec)
         self._get_header()
         self._spec = {'header': self._header,
                       'paths': {}}
@@ -76,6 +171,7 @@ class MtreeXML(object):
             'size': None,  # Size of the file in bytes (int).
             'tags': [],  # mtree-internal tags (comma-separated in the mtree spec).
             'time': None,  # Time the file was last modified (in Epoch fmt as float).
+            '_time': None,  # The time as it was in the spec (str), for verify(). Not part of the XML.
             'uid': None,  # File owner UID (int)
             'uname': None  # File owner username (str)
             # And lastly, "children" is where the children files/directories go. We don't include it in the template;
@@ -84,17 +180,42 @@ class MtreeXML(object):
             }
         # Global aspects are handled by "/set" directives.
         # They are restored by an "/unset". Since they're global and stateful, they're handled as a class attribute.
-        self._settings = copy.deepcopy(self._tplitem)
-        self._parse_items()
-        del(self._settings, self._tplitem, self._strptime_fmt, self._specdata)
+        self._settings = self._tplitem
+        if not stream:
+            for path, item in self.items():
+                self._spec['paths'][path] = item
 
+    def _read_lines(self, fh):
+        # Yields one logical line at a time; we handle the escaped linebreaking mtree does here
+        # (a trailing backslash continues the entry on the next line).
+        _contre = re.compile('\\\\\s*$')
+        buf = ''
+        for line in fh:
+            if isinstance(line, bytes):
+                try:
+                    line = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError('spec must be a utf-8 encoded set of bytes if using byte mode')
+            if buf:
+                line = line.lstrip()
+            if _contre.search(line):
+                buf += _contre.sub('', line)
+                continue
+            yield(buf + line.rstrip('\r\n'))
+            buf = ''
+        if buf:
+            yield(buf)
 
     def _get_header(self):
         self._header = {}
         _headre = re.compile('^#\s+(user|machine|tree|date):\s')
         _cmtre = re.compile('^\s*#\s*')
         _blklnre = re.compile('^\s*$')
-        for idx, line in enumerate(self._specdata):
+        # We only consume as much of the spec as we need to for the header; anything we read past it gets
+        # put back in front of the rest of the lines for items().
+        _seen = []
+        for line in self._specdata:
+            _seen.append(line)
             if _headre.search(line):  # We found a header item.
                 l = [i.lstrip() for i in _cmtre.sub('', line).split(':', 1)]
                 header = l[0]
@@ -108,9 +229,11 @@ class MtreeXML(object):
                 break  # We've reached the end of the header. Otherwise...
             else:  # We definitely shouldn't be here, but this means the spec doesn't even have a header.
                 break
+        self._specdata = itertools.chain(_seen, self._specdata)
         return()
 
-    def _parse_items(self):
+    def items(self):
+        # A generator; yields a tuple of (path, item settings) for each item in the spec as it's parsed.
         # A pattern (compiled for performance) to match commands.
         _stngsre = re.compile('^/(un)?set\s')
         # Per the man page:
@@ -121,7 +244,7 @@ class MtreeXML(object):
         # The following regex is to test if we need to traverse upwards in the path.
         _parentre = re.compile('^\.{,2}/?$')
         # _curpath = self.header['tree']
-        _curpath = pathlib.PosixPath('/')
+        _curpath = '/'
         _types = ('block', 'char', 'dir', 'fifo', 'file', 'link', 'socket')
         # This parses keywords. Used by both item specs and /set.
         def _kwparse(kwline):
@@ -153,6 +276,7 @@ class MtreeXML(object):
                 elif _hashre.search(k):
                     k = _hashre.sub('\g<1>', k)
                 elif k == 'time':
+                    out['_time'] = v
                     v = datetime.datetime.fromtimestamp(float(v))
                 elif k == 'type':
                     if v not in _types:
@@ -162,44 +286,49 @@ class MtreeXML(object):
         def _unset_parse(unsetline):
             out = {}
             if unsetline[1] == 'all':
-                return(copy.deepcopy(self._tplitem))
-            for i in unsetline:
+                return(self._tplitem)
+            for i in unsetline[1:]:
                 out[i] = self._tplitem[i]
             return(out)
         # The Business-End (TM)
-        for idx, line in enumerate(self._specdata):
-            _fname = copy.deepcopy(_curpath)
+        # self._settings is never modified in place; /set and /unset replace it with a new dict instead.
+        # That way each item only needs a shallow copy of the current settings rather than a deepcopy (the
+        # values themselves are never mutated, just replaced). The current path is kept as a plain string for
+        # the same reason.
+        for line in self._specdata:
             # Skip these lines
             if _ignre.search(line):
                 continue
             l = line.split()
-            if _parentre.search(line):
-                _curpath = _curpath.parent
+            if _parentre.search(l[0]) and len(l) == 1:
+                _curpath = posixpath.dirname(_curpath)
             elif not _stngsre.search(line):
                 # So it's an item, not a command.
-                _itemsettings = copy.deepcopy(self._settings)
+                _itemsettings = dict(self._settings)
                 _itemsettings.update(_kwparse(l[1:]))
-                if _itemsettings['type'] == 'dir':
-                    # SOMEONE PLEASE let me know if there's a cleaner way to do this.
-                    _curpath = pathlib.PosixPath(os.path.normpath(_curpath.joinpath(l[0])))
-                    _fname = _curpath
+                if '/' in l[0]:
+                    # Per mtree(5), a filename with a slash in it is a full path (relative to the root), and does not
+                    # change the current directory. This is what e.g. bsdtar --format=mtree generates.
+                    _fname = posixpath.normpath(posixpath.join('/', l[0]))
                 else:
-                    _fname = pathlib.PosixPath(os.path.normpath(_curpath.joinpath(l[0])))
-                self._spec['paths'][_fname] = _itemsettings
+                    _fname = posixpath.normpath(posixpath.join(_curpath, l[0]))
+                    if _itemsettings['type'] == 'dir':
+                        _curpath = _fname
+                yield(pathlib.PosixPath(_fname), _itemsettings)
             else:
                 # It's a command. We can safely split on whitespace since the man page specifies the
                 # values are not to contain whitespace.
                 # /set
                 if l[0] == '/set':
                     del(l[0])
-                    self._settings.update(_kwparse(l))
+                    self._settings = dict(self._settings, **_kwparse(l))
                 # /unset
                 else:
-                    self._settings.update(_unset_parse(l))
+                    self._settings = dict(self._settings, **_unset_parse(l))
                 continue
-        return()
+        return
 
-    def convert(self, architecture = 'shallow'):
+    def convert(self, architecture = 'shallow', out = None):
         # If architecture is 'shallow', create the following structure:
         # <mtree ...>
         #   <item path='/path/to/item' keyword1='kw1_value' ... />
@@ -226,55 +355,176 @@ class MtreeXML(object):
         # _xsi = {
         #     '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation': 'http://mtreexml.square-r00t.net mtree.xsd'}
         #self.cfg = lxml.etree.Element('mtree', nsmap = _ns, attrib = _xsi)
-        self.xml = lxml.etree.Element('mtree')
-        # Add the header(s)
-        for k in self._header:
-            if not isinstance(self._header[k], str):
-                self._header[k] = str(self._header[k])
-            self.xml.attrib[k] = copy.deepcopy(self._header[k])
-        # We use this compiled regex to format octals into string representations.
-        _octre = re.compile('^0o')
+        # If out is a (binary) file object, the XML is written to it incrementally as the items are parsed
+        # instead of building the whole tree (and self.xml/self.xml_str) in memory.
+        _header = {k: str(v) for k, v in self._header.items()}
+        # If we were constructed with stream = True, nothing's been collected; pull the items from the parser.
+        _items = (self._spec['paths'].items() if self._spec['paths'] else self.items())
+        if out:
+            with lxml.etree.xmlfile(out, encoding = 'utf-8') as xf:
+                xf.write_declaration()
+                with xf.element('mtree', attrib = _header):
+                    xf.flush()
+                    for path, item in _items:
+                        # Indent it the same way pretty_print would if it were part of the whole tree.
+                        p = self._item_element(path, item, architecture)
+                        lxml.etree.indent(p, level = 1)
+                        xf.write('\n  ')
+                        xf.write(p)
+                    xf.write('\n')
+                xf.flush()
+                out.write(b'\n')
+            return()
+        self.xml = lxml.etree.Element('mtree', attrib = _header)
         # Now add the paths.
-        for path in self._spec['paths']:
-            p = lxml.etree.Element('item')
-            if architecture == 'deep':
-                e = lxml.etree.Element('path')
-                e.text = str(path)
-                p.append(e)
-            for k in self._spec['paths'][path]:
-                # None attributes
-                if not self._spec['paths'][path][k]:
-                    continue
-                # Bools
-                if isinstance(self._spec['paths'][path][k], bool):
-                    if architecture == 'shallow':
-                        self._spec['paths'][path][k] = str(self._spec['paths'][path][k]).lower()
-                    elif architecture == 'deep':
-                        e = lxml.etree.Element(k)
-                        e.attrib['enabled'] = str(self._spec['paths'][path][k]).lower()
-                        p.append(e)
-                        continue
-                # Modes are stored in int, so we need a string repr of octal.
-                if k == 'mode':
-                    self._spec['paths'][path][k] = '{0:0>4}'.format(_octre.sub('',
-                                                                               str(oct(self._spec['paths'][path][k]))))
-                if not isinstance(self._spec['paths'][path][k], str):
-                    self._spec['paths'][path][k] = str(self._spec['paths'][path][k])
-                if architecture == 'shallow':
-                    if 'path' not in p.attrib:
-                        p.attrib['path'] = str(path)
-                    p.attrib[k] = self._spec['paths'][path][k]
-                elif architecture == 'deep':
-                    e = lxml.etree.Element(k)
-                    e.text = self._spec['paths'][path][k]
-                    p.append(e)
-            self.xml.append(p)
+        for path, item in _items:
+            self.xml.append(self._item_element(path, item, architecture))
         self.xml_str = lxml.etree.tostring(self.xml,
                                            encoding = 'utf-8',
                                            xml_declaration = True,
                                            pretty_print = True).decode('utf-8')
         return()
 
+    def _item_element(self, path, item, architecture):
+        # We use this compiled regex to format octals into string representations.
+        _octre = re.compile('^0o')
+        p = lxml.etree.Element('item')
+        if architecture == 'shallow':
+            p.attrib['path'] = str(path)
+        elif architecture == 'deep':
+            e = lxml.etree.Element('path')
+            e.text = str(path)
+            p.append(e)
+        for k, v in item.items():
+            # None attributes, and internal ones
+            if not v or k.startswith('_'):
+                continue
+            # Bools
+            if isinstance(v, bool):
+                if architecture == 'shallow':
+                    v = str(v).lower()
+                elif architecture == 'deep':
+                    e = lxml.etree.Element(k)
+                    e.attrib['enabled'] = str(v).lower()
+                    p.append(e)
+                    continue
+            # Modes are stored in int, so we need a string repr of octal.
+            if k == 'mode':
+                v = '{0:0>4}'.format(_octre.sub('', str(oct(v))))
+            if not isinstance(v, str):
+                v = str(v)
+            if architecture == 'shallow':
+                p.attrib[k] = v
+            elif architecture == 'deep':
+                e = lxml.etree.Element(k)
+                e.text = v
+                p.append(e)
+        return(p)
+
+    def verify(self, root, workers = None, pool = 'thread', bufsize = 1048576):
+        # A generator; compares the filesystem under root against the spec and yields a tuple of
+        # (path, keyword, expected, found) for each mismatch. keyword is 'missing' or 'extra' for items only in the
+        # spec or only on disk, respectively. Checksums are computed in a pool (pool is 'thread' or 'process') of
+        # workers; each file is read once regardless of how many digests it has. Results are yielded in spec order.
+        if pool not in ('thread', 'process'):
+            raise ValueError('pool must be one of: thread, process')
+        root = os.path.abspath(os.path.expanduser(root))
+        if not workers:
+            workers = os.cpu_count()
+        _executor = (concurrent.futures.ThreadPoolExecutor
+                     if pool == 'thread' else
+                     concurrent.futures.ProcessPoolExecutor)
+        # We only keep a bounded number of files in flight so huge specs don't queue up the whole tree at once.
+        _maxpending = workers * 4
+        _pending = collections.deque()
+        _seen = set()
+        _ignored = set()
+        _items = (self._spec['paths'].items() if self._spec['paths'] else self.items())
+        with _executor(max_workers = workers) as executor:
+            for path, item in _items:
+                fpath = os.path.normpath(os.path.join(root, str(path).lstrip('/')))
+                # We have to hang on to the paths (but not the items) to find the extra files afterwards.
+                _seen.add(fpath)
+                if item['ignore']:
+                    _ignored.add(fpath)
+                results = []
+                hashtypes = [k for k in itertools.chain(('cksum', ), _hashtypes) if item.get(k) is not None]
+                try:
+                    st = os.lstat(fpath)
+                except FileNotFoundError:
+                    if not item['optional']:
+                        results.append((path, 'missing', None, None))
+                    _pending.append((path, item, results, None))
+                else:
+                    results.extend(self._verify_stat(path, item, fpath, st))
+                    future = None
+                    # No sense in reading the file if it's not a file or the size is already off.
+                    if (hashtypes
+                            and stat.S_ISREG(st.st_mode)
+                            and not [r for r in results if r[1] in ('type', 'size')]):
+                        future = executor.submit(digest_file, fpath, hashtypes, bufsize)
+                    _pending.append((path, item, results, future))
+                while len(_pending) > _maxpending:
+                    for r in self._verify_digests(*_pending.popleft()):
+                        yield(r)
+            while _pending:
+                for r in self._verify_digests(*_pending.popleft()):
+                    yield(r)
+        # And anything on disk that isn't in the spec.
+        for dirpath, dirs, files in os.walk(root):
+            if dirpath in _ignored:
+                dirs[:] = []
+                continue
+            for f in dirs + files:
+                fpath = os.path.join(dirpath, f)
+                if fpath not in _seen:
+                    yield(pathlib.PosixPath('/', os.path.relpath(fpath, root)), 'extra', None, None)
+        return
+
+    def _verify_stat(self, path, item, fpath, st):
+        out = []
+        for test, ftype in _stattypes:
+            if test(st.st_mode):
+                break
+        else:
+            ftype = None
+        if item['type'] and item['type'] != ftype:
+            # Nothing else is going to line up if the type doesn't.
+            return([(path, 'type', item['type'], ftype)])
+        if isinstance(item['mode'], int) and item['mode'] != stat.S_IMODE(st.st_mode):
+            out.append((path, 'mode', '{0:04o}'.format(item['mode']), '{0:04o}'.format(stat.S_IMODE(st.st_mode))))
+        for k, v in (('uid', st.st_uid), ('gid', st.st_gid), ('nlink', st.st_nlink)):
+            if isinstance(item[k], int) and item[k] != v:
+                out.append((path, k, item[k], v))
+        if item['size'] is not None and ftype == 'file' and int(item['size']) != st.st_size:
+            out.append((path, 'size', int(item['size']), st.st_size))
+        if item['time'] is not None and ftype != 'link':
+            # Compared in integers, at however many digits of a second the spec has (a float can't hold
+            # nanoseconds since the epoch exactly).
+            sec, frac, digits = mtime_parse(item['_time'])
+            st_sec, st_nsec = divmod(st.st_mtime_ns, 1000000000)
+            st_frac = st_nsec // (10 ** (9 - digits))
+            if (sec, frac) != (st_sec, st_frac):
+                out.append((path,
+                            'time',
+                            item['_time'],
+                            ('{0}.{1:0{2}d}'.format(st_sec, st_frac, digits) if digits else str(st_sec))))
+        if item['link'] is not None and ftype == 'link':
+            target = os.readlink(fpath)
+            if target != item['link']:
+                out.append((path, 'link', item['link'], target))
+        return(out)
+
+    def _verify_digests(self, path, item, results, future):
+        if future:
+            for k, v in future.result().items():
+                expected = item[k]
+                if k != 'cksum':
+                    expected = expected.lower()
+                if expected != v:
+                    results.append((path, k, expected, v))
+        return(results)
+
 def parseArgs():
     args = argparse.ArgumentParser(description = 'Parse BSD-style mtree specs into XML.')
     xmlarch = args.add_mutually_exclusive_group()
@@ -290,27 +540,57 @@ def parseArgs():
                          const = 'deep',
                          default = 'shallow',
                          help = 'If specified, create a "deep" XML structure (conflicts with -s/--shallow)')
+    args.add_argument('-V', '--verify',
+                      dest = 'verify',
+                      metavar = 'ROOT',
+                      help = ('If specified, instead of converting to XML, verify the directory ROOT against the spec '
+                              'and print any mismatches'))
+    args.add_argument('-w', '--workers',
+                      dest = 'workers',
+                      type = int,
+                      default = os.cpu_count(),
+                      help = ('The number of checksum workers to use with -V/--verify. '
+                              'Default is the number of CPUs ({0})').format(os.cpu_count()))
+    args.add_argument('-p', '--pool',
+                      dest = 'pool',
+                      choices = ('thread', 'process'),
+                      default = 'thread',
+                      help = ('The type of worker pool to use for checksums with -V/--verify. Default is thread'))
     args.add_argument('specfile',
                       nargs = '?',
-                      help = ('The path to the mtree spec file. Ignored if data is piped to stdin'))
+                      help = ('The path to the mtree spec file. If not specified, the spec is read from stdin'))
     return(args)
 
+def run(mtree, args):
+    if not args['verify']:
+        mtree.convert(args['architecture'], out = sys.stdout.buffer)
+        return(True)
+    ok = True
+    for path, keyword, expected, found in mtree.verify(args['verify'],
+                                                       workers = args['workers'],
+                                                       pool = args['pool']):
+        ok = False
+        if keyword in ('missing', 'extra'):
+            print('{0}: {1}'.format(path, keyword))
+        else:
+            print('{0}: {1} (expected {2}, found {3})'.format(path, keyword, expected, found))
+    return(ok)
+
 def main():
     args = vars(parseArgs().parse_args())
-    stdin = None
-    if not sys.stdin.isatty():
-        stdin = sys.sdtin.buffer.read()
-    if stdin:
-        args['spec'] = stdin
-    else:
-        if not args['specfile']:
+    # An explicit specfile always wins; stdin is only read when there isn't one (it's not a tty under cron,
+    # subprocess etc. even when nothing is being piped in).
+    if not args['specfile']:
+        if sys.stdin.isatty():
             raise argparse.ArgumentError(None, 'You must specify a specfile if you are not piping in one!')
+        ok = run(MtreeXML(sys.stdin.buffer, stream = True), args)
+    else:
         args['specfile'] = os.path.abspath(os.path.expanduser(args['specfile']))
         with open(args['specfile'], 'r') as f:
-            args['spec'] = f.read()
-    mtree = MtreeXML(args['spec'])
-    mtree.convert(args['architecture'])
-    print(mtree.xml_str)
+            ok = run(MtreeXML(f, stream = True), args)
+    if not ok:
+        sys.exit(2)
+    return()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import resource
+import time
+##
+import mtree_to_xml
+
+
+# Times MtreeXML parsing against a synthetic spec. Run it from a checkout of the revision you want to compare
+# (e.g. before and after a parser change) so the numbers are apples to apples.
+
+def gen_spec(entries, files_per_dir = 100):
+    spec = io.StringIO()
+    spec.write(('#          user: root\n'
+                '#       machine: bench\n'
+                '#          tree: /\n'
+                '#          date: Mon Jan  1 00:00:00 2018\n'
+                '\n'
+                '/set type=file uid=0 gid=0 mode=0644 nlink=1\n'
+                '.               type=dir mode=0755 nlink=2 time=1514764800.0\n'))
+    written = 0
+    d = 0
+    while written < entries:
+        spec.write('    dir{0:07d}      type=dir mode=0755 nlink=2 time=1514764800.0\n'.format(d))
+        written += 1
+        for f in range(files_per_dir):
+            if written >= entries:
+                break
+            spec.write(('        file{0:04d}     size={1} time=1514764800.0 \\\n'
+                        '                    sha256digest={2:064x}\n').format(f, f * 512, written))
+            written += 1
+        spec.write('    ..\n')
+        d += 1
+    spec.write('..\n')
+    return(spec.getvalue())
+
+def bench(spec):
+    start = time.perf_counter()
+    mtree = mtree_to_xml.MtreeXML(spec)
+    elapsed = time.perf_counter() - start
+    count = len(mtree._spec['paths'])
+    return(count, elapsed)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark MtreeXML parsing over a synthetic mtree spec.')
+    args.add_argument('-n', '--entries',
+                      dest = 'entries',
+                      type = int,
+                      default = 1000000,
+                      help = 'The number of entries to put in the synthetic spec. Default is 1000000')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    spec = gen_spec(args['entries'])
+    count, elapsed = bench(spec)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('Parsed {0} entries in {1:.2f}s ({2:.0f} entries/s); peak RSS {3:.1f} MiB'.format(count,
+                                                                                         elapsed,
+                                                                                         count / elapsed,
+                                                                                         peak / 1024))
+    return()
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import hashlib
 import json
 import os
 import platform
 import re
 import shutil
+import struct
 import subprocess
+import threading
+import time
 ##
 import magic  # From http://darwinsys.com/file/, not https://github.com/ahupp/python-magic
 import psutil
@@ -15,11 +19,24 @@ from lxml import etree
 
 
 class BootSync(object):
-    def __init__(self, cfg = None, validate = True, dryrun = False, *args, **kwargs):
+    def __init__(self, cfg = None, validate = True, dryrun = False, statefile = None, *args, **kwargs):
         if not cfg:
             self.cfgfile = '/etc/bootsync.xml'
         else:
             self.cfgfile = os.path.abspath(os.path.expanduser(cfg))
+        # The size/mtime/ctime and hash of every file we hashed on the last run, so we can skip rehashing anything
+        # that hasn't changed since.
+        if not statefile:
+            self.statefile = '/var/cache/bootsync/state.json'
+        else:
+            self.statefile = os.path.abspath(os.path.expanduser(statefile))
+        self.state = {}
+        self.newstate = {}
+        self.stateLock = threading.Lock()
+        # The st_dev of every mounted FAT filesystem (i.e. the ESPs); see _statTrusted().
+        self.fatDevs = set()
+        # Where the schema (and whether the config validated against it) is cached.
+        self.cachedir = os.path.dirname(self.statefile)
         self.ns = None
         self.cfg = None
         self.xml = None
@@ -33,9 +50,12 @@ class BootSync(object):
         self.blkids = {}
         self.dummy_uuid = None
         self.syncs = {}
+        self.checkHashes = {}
         ##
+        self.loadState()
         self.getCfg(validate = validate)
         self.chkMounts(dryrun = dryrun)
+        self.getFatDevs()
         self.chkReboot()
         self.getChecks()
         self.getBlkids()
@@ -55,16 +75,86 @@ class BootSync(object):
         self.ns = self.cfg.nsmap.get(None, 'http://git.square-r00t.net/OpTools/tree/sys/BootSync/')
         self.ns = '{{{0}}}'.format(self.ns)
         if validate:
+            xsi = self.cfg.nsmap.get('xsi', 'http://www.w3.org/2001/XMLSchema-instance')
+            schemaLocation = '{{{0}}}schemaLocation'.format(xsi)
+            schemaURL = self.cfg.attrib.get(schemaLocation,
+                                            ('http://git.square-r00t.net/OpTools/plain/sys/BootSync/bootsync.xsd'))
             if not self.schema:
-                from urllib.request import urlopen
-                xsi = self.cfg.nsmap.get('xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-                schemaLocation = '{{{0}}}schemaLocation'.format(xsi)
-                schemaURL = self.cfg.attrib.get(schemaLocation,
-                                                ('http://git.square-r00t.net/OpTools/plain/sys/BootSync/bootsync.xsd'))
-                with urlopen(schemaURL) as url:
-                    self.schema = url.read()
-            self.schema = etree.XMLSchema(etree.XML(self.schema))
-            self.schema.assertValid(self.xml)
+                self.schema = self._getSchema(schemaURL)
+            # lxml can't serialize a compiled XMLSchema, so instead we remember that this exact config validated
+            # against this exact schema last time and skip compiling/validating it at all if neither has changed.
+            validated = hashlib.sha256(self.schema + etree.tostring(self.xml)).hexdigest()
+            validfile = os.path.join(self.cachedir, 'validated')
+            if os.path.isfile(validfile):
+                with open(validfile, 'r') as f:
+                    if f.read().strip() == validated:
+                        return()
+            schema = etree.XMLSchema(etree.XML(self.schema))
+            schema.assertValid(self.xml)
+            self._writeCache(validfile, validated.encode('utf-8'))
+        return()
+
+    def _getSchema(self, schemaURL, ttl = 86400):
+        # Returns the XSD (as bytes). In order of preference:
+        # - the cached copy, if it's less than ttl seconds old
+        # - the cached copy, if the server says it hasn't changed (conditional GET); otherwise the new one
+        # - the cached copy, if the server can't be reached
+        # - the copy bundled alongside this script
+        from urllib.error import HTTPError, URLError
+        from urllib.request import Request, urlopen
+        xsdfile = os.path.join(self.cachedir, 'bootsync.xsd')
+        metafile = '{0}.json'.format(xsdfile)
+        meta = {}
+        if os.path.isfile(xsdfile) and os.path.isfile(metafile):
+            with open(metafile, 'r') as f:
+                meta = json.load(f)
+            if meta.get('url') != schemaURL:
+                meta = {}
+        if meta and (time.time() - os.path.getmtime(metafile)) < ttl:
+            with open(xsdfile, 'rb') as f:
+                return(f.read())
+        req = Request(schemaURL)
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            with urlopen(req, timeout = 10) as url:
+                schema = url.read()
+                meta = {'url': schemaURL,
+                        'etag': url.headers.get('ETag'),
+                        'last_modified': url.headers.get('Last-Modified')}
+            self._writeCache(xsdfile, schema)
+            self._writeCache(metafile, json.dumps(meta).encode('utf-8'))
+            return(schema)
+        except HTTPError as e:
+            if e.code != 304 and not meta:
+                return(self._getBundledSchema(e))
+        except (URLError, OSError) as e:
+            if not meta:
+                return(self._getBundledSchema(e))
+        # Not modified (or unreachable); reuse the cached copy and reset the TTL.
+        self._writeCache(metafile, json.dumps(meta).encode('utf-8'))
+        with open(xsdfile, 'rb') as f:
+            return(f.read())
+
+    def _getBundledSchema(self, err):
+        xsdfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bootsync.xsd')
+        if not os.path.isfile(xsdfile):
+            raise RuntimeError(('Could not fetch the schema ({0}) and there is no cached or bundled copy; '
+                                'try -V/--no-validate').format(err))
+        with open(xsdfile, 'rb') as f:
+            return(f.read())
+
+    def _writeCache(self, fpath, data):
+        # The cache is just an optimization; if we can't write it (e.g. not root), carry on without it.
+        try:
+            os.makedirs(os.path.dirname(fpath), exist_ok = True)
+            with open('{0}.tmp'.format(fpath), 'wb') as f:
+                f.write(data)
+            os.replace('{0}.tmp'.format(fpath), fpath)
+        except OSError:
+            pass
         return()
 
     def chkMounts(self, dryrun = False):
@@ -89,6 +179,15 @@ class BootSync(object):
                             pass
         return()
 
+    def getFatDevs(self):
+        for m in psutil.disk_partitions(all = True):
+            if m.fstype.lower() in ('vfat', 'msdos', 'fat', 'exfat'):
+                try:
+                    self.fatDevs.add(os.stat(m.mountpoint).st_dev)
+                except OSError:
+                    pass
+        return()
+
     def chkReboot(self):
         self._getInstalledKernel()
         if not self.kernelFile:
@@ -140,6 +239,7 @@ class BootSync(object):
         # Get the default hashtype (if one exists)
         fc = self.cfg.find('{0}fileChecks'.format(self.ns))
         default_hashtype = fc.attrib.get('hashtype', 'md5').lower()
+        checks = []
         for f in fc.findall('{0}file'.format(self.ns)):
             # We do /boot files manually in case it isn't specified as a
             # separate mount.
@@ -147,31 +247,34 @@ class BootSync(object):
             rel_fpath = f.text
             fpath = os.path.join('/boot', rel_fpath)
             canon_hash = self._get_hash(fpath, file_hashtype)
-            for esp in self.cfg.findall('{0}partitions/{0}part'.format(self.ns)):
-                mount = os.path.abspath(os.path.expanduser(esp.attrib['mount']))
+            checks.append((rel_fpath, file_hashtype, canon_hash))
+            self.checkHashes[rel_fpath] = (file_hashtype, canon_hash)
+        # The ESPs are compared against the canonical hashes in parallel, one worker per disk.
+        for mismatches in self._perDevice('fileChecks', self._checkDevice, checks).values():
+            for rel_fpath, mount in mismatches:
+                if rel_fpath not in self.syncs:
+                    self.syncs[rel_fpath] = []
+                self.syncs[rel_fpath].append(mount)
+        return()
+
+    def _checkDevice(self, mounts, checks):
+        mismatches = []
+        for mount in mounts:
+            for rel_fpath, file_hashtype, canon_hash in checks:
                 new_fpath = os.path.join(mount, rel_fpath)
                 file_hash = self._get_hash(new_fpath, file_hashtype)
                 if not file_hashtype or file_hash != canon_hash or not file_hash:
-                    if rel_fpath not in self.syncs:
-                        self.syncs[rel_fpath] = []
-                    self.syncs[rel_fpath].append(mount)
-        return()
+                    mismatches.append((rel_fpath, mount))
+        return(mismatches)
 
     def sync(self, dryrun = False, *args, **kwargs):
         if not dryrun:
             if os.geteuid() != 0:
                 raise PermissionError('You must be root to write to the appropriate destinations')
-        # fileChecks are a *lot* easier.
-        for rel_fpath, mounts in self.syncs.items():
-            for bootdir in mounts:
-                source = os.path.join('/boot', rel_fpath)
-                target = os.path.join(bootdir, rel_fpath)
-                destdir = os.path.dirname(target)
-                if not dryrun:
-                    os.makedirs(destdir, exist_ok = True)
-                    shutil.copy2(source, target)
-        bootmounts = [e.attrib['mount'] for e in self.cfg.findall('{0}partitions/{0}part'.format(self.ns))]
         # syncPaths
+        # The sources are the same for every ESP, so we walk and hash them once up front; the per-disk workers only
+        # have to hash and copy their own destinations.
+        syncfiles = []
         syncpaths = self.cfg.find('{0}syncPaths'.format(self.ns))
         default_hashtype = syncpaths.attrib.get('hashtype', 'md5').lower()
         for syncpath in syncpaths.findall('{0}path'.format(self.ns)):
@@ -192,20 +295,76 @@ class BootSync(object):
                     boottarget = os.path.join(target, fname_path)
                     if ptrn.search(f):
                         # Compare the contents.
-                        orig_hash = self._get_hash(bootsource, file_hashtype)
-                        for bootdir in bootmounts:
-                            bootfile = os.path.join(bootdir, boottarget)
-                            if not dryrun:
-                                if not os.path.isfile(bootfile):
-                                    os.makedirs(os.path.dirname(bootfile),
-                                                exist_ok = True)
-                                    shutil.copy2(bootsource, bootfile)
-                                else:
-                                    dest_hash = self._get_hash(bootfile, file_hashtype)
-                                    if not file_hashtype or orig_hash != dest_hash:
-                                        shutil.copy2(bootsource, bootfile)
+                        orig_hash = (self._get_hash(bootsource, file_hashtype) if not dryrun else None)
+                        syncfiles.append((bootsource, boottarget, file_hashtype, orig_hash))
+        self._perDevice('sync', self._syncDevice, syncfiles, dryrun)
         return()
 
+    def _syncDevice(self, mounts, syncfiles, dryrun = False):
+        # fileChecks are a *lot* easier.
+        for rel_fpath, sync_mounts in self.syncs.items():
+            for bootdir in mounts:
+                if bootdir not in sync_mounts:
+                    continue
+                source = os.path.join('/boot', rel_fpath)
+                target = os.path.join(bootdir, rel_fpath)
+                destdir = os.path.dirname(target)
+                if not dryrun:
+                    os.makedirs(destdir, exist_ok = True)
+                    shutil.copy2(source, target)
+                    self._recordCopy(target, *self.checkHashes[rel_fpath])
+        if dryrun:
+            return()
+        for bootdir in mounts:
+            for bootsource, boottarget, file_hashtype, orig_hash in syncfiles:
+                bootfile = os.path.join(bootdir, boottarget)
+                if not os.path.isfile(bootfile):
+                    os.makedirs(os.path.dirname(bootfile),
+                                exist_ok = True)
+                    shutil.copy2(bootsource, bootfile)
+                    self._recordCopy(bootfile, file_hashtype, orig_hash)
+                else:
+                    dest_hash = self._get_hash(bootfile, file_hashtype)
+                    if not file_hashtype or orig_hash != dest_hash:
+                        shutil.copy2(bootsource, bootfile)
+                        self._recordCopy(bootfile, file_hashtype, orig_hash)
+        return()
+
+    def _perDevice(self, action, func, *args):
+        # Runs func(mounts, *args) for each physical disk the ESPs are on, in parallel. Mounts on the same disk are
+        # handled by the same worker (sequentially), so we never have two workers seeking on one disk.
+        devices = {}
+        for esp in self.cfg.findall('{0}partitions/{0}part'.format(self.ns)):
+            disk = self._getParentDisk(esp.attrib['path'])
+            mount = os.path.abspath(os.path.expanduser(esp.attrib['mount']))
+            if disk not in devices:
+                devices[disk] = []
+            devices[disk].append(mount)
+        results = {}
+        if not devices:
+            return(results)
+        def _timed(mounts):
+            start = time.monotonic()
+            ret = func(mounts, *args)
+            return(time.monotonic() - start, ret)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(devices)) as executor:
+            futures = {executor.submit(_timed, mounts): disk for disk, mounts in devices.items()}
+            for future in concurrent.futures.as_completed(futures):
+                disk = futures[future]
+                elapsed, results[disk] = future.result()
+                # TODO: logger?
+                print('{0} ({1}): {2} took {3:.2f}s'.format(disk, ', '.join(devices[disk]), action, elapsed))
+        return(results)
+
+    def _getParentDisk(self, devpath):
+        # /dev/sdb1 -> /dev/sdb, /dev/nvme0n1p1 -> /dev/nvme0n1, etc. If we can't tell (or it's not a partition), we
+        # just use the device itself.
+        devname = os.path.basename(os.path.realpath(devpath))
+        sysblock = os.path.realpath(os.path.join('/sys/class/block', devname))
+        if os.path.isfile(os.path.join(sysblock, 'partition')):
+            return(os.path.join('/dev', os.path.basename(os.path.dirname(sysblock))))
+        return(os.path.join('/dev', devname))
+
 
     def writeConfs(self, dryrun = False, *args, **kwargs):
         if not dryrun:
@@ -249,11 +408,77 @@ class BootSync(object):
             raise ValueError('Hashtype {0} is not supported on this system'.format(hashtype))
         hasher = getattr(hashlib, hashtype)
         fpathname = os.path.abspath(os.path.expanduser(fpathname))
+        st = os.stat(fpathname)
+        statkey = self._statKey(st, hashtype)
+        trusted = self._statTrusted(st)
+        cached = (self.state.get(fpathname) if trusted else None)
+        if cached and all(cached.get(k) == v for k, v in statkey.items()):
+            with self.stateLock:
+                self.newstate[fpathname] = cached
+            return(cached['hash'])
         _hash = hasher()
+        # Stream it in chunks; some of these (ISOs, etc.) can be several GB.
+        buf = bytearray(1048576)
+        view = memoryview(buf)
         with open(fpathname, 'rb') as fh:
-            _hash.update(fh.read())
+            while True:
+                n = fh.readinto(buf)
+                if not n:
+                    break
+                _hash.update(view[:n])
+        if trusted:
+            with self.stateLock:
+                self.newstate[fpathname] = dict(statkey, hash = _hash.hexdigest())
         return (_hash.hexdigest())
 
+    def _statKey(self, st, hashtype):
+        # ctime can't be set from userspace (unlike mtime, which e.g. copy2 preserves), so on most filesystems any
+        # write to the file since we last hashed it will change it. See _statTrusted() for where that isn't so.
+        return({'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'ctime_ns': st.st_ctime_ns,
+                'hashtype': hashtype})
+
+    def _statTrusted(self, st):
+        # Whether _statKey() can tell us a file hasn't changed. On FAT (which the ESPs are), there's no change time:
+        # depending on the driver, ctime is either the creation time or just a copy of mtime, so a same-size file
+        # copied in with copy2 (which keeps mtime) could look untouched. Files there always get rehashed.
+        return(st.st_dev not in self.fatDevs)
+
+    def _recordCopy(self, target, hashtype, filehash):
+        # We just copied a file we already know the hash of; no need to read it back in on the next run.
+        if not filehash or hashtype.lower() == 'false':
+            return()
+        target = os.path.abspath(os.path.expanduser(target))
+        st = os.stat(target)
+        if not self._statTrusted(st):
+            return()
+        with self.stateLock:
+            self.newstate[target] = dict(self._statKey(st, hashtype), hash = filehash)
+        return()
+
+    def loadState(self):
+        if not os.path.isfile(self.statefile):
+            return()
+        try:
+            with open(self.statefile, 'r') as f:
+                self.state = json.load(f)
+        except (ValueError, OSError):
+            # Corrupt or unreadable; we'll just rehash everything and write a fresh one.
+            self.state = {}
+        return()
+
+    def writeState(self, dryrun = False, *args, **kwargs):
+        # Only what we saw this run gets written out, so files that no longer exist drop out of the state.
+        if dryrun:
+            return()
+        os.makedirs(os.path.dirname(self.statefile), exist_ok = True)
+        tmpfile = '{0}.tmp'.format(self.statefile)
+        with open(tmpfile, 'w') as f:
+            json.dump(self.newstate, f)
+        os.replace(tmpfile, self.statefile)
+        return()
+
     def _getRunningKernel(self):
         _vers = []
         # If we change the version string capture in get_file_kernel_ver(),
@@ -270,9 +495,6 @@ class BootSync(object):
             return(_vers[0])
 
     def _getInstalledKernel(self):
-        # Could we maybe remove the dependency for the "magic" module with a struct?
-        # http://lxr.linux.no/#linux+v2.6.39/Documentation/x86/boot.txt
-        # https://stackoverflow.com/a/11179559/733214
         try:
             len(self.cfg)
         except TypeError:
@@ -285,31 +507,58 @@ class BootSync(object):
             if isKernel:
                 self.kernelFile = f.text
         if self.kernelFile:
-            with open(os.path.join('/boot', self.kernelFile), 'rb') as fh:
-                magicname = magic.detect_from_content(fh.read())
-            names = [i.strip().split(None, 1) for i in magicname.name.split(',') if i.strip() != '']
-            for n in names:
-                if len(n) != 2:
-                    continue
-                k, v = n
-                # Note: this only grabs the version number.
-                # If we want to get e.g. the build user/machine, date, etc.,
-                # then we need to do a join. Shouldn't be necessary, though.
-                if k.lower() == 'version':
-                    self.installedKernVer = v.split(None, 1)[0]
+            self.installedKernVer = self._getKernelVersion(os.path.join('/boot', self.kernelFile))
         return()
 
+    def _getKernelVersion(self, kpath):
+        # We read the version straight out of the x86 boot protocol header instead of handing the whole image to
+        # libmagic; it's only a few hundred bytes.
+        # https://www.kernel.org/doc/html/latest/x86/boot.html
+        # The setup header starts at 0x1f1. 0x202 is the "HdrS" magic, 0x206 the boot protocol version, and 0x20e is
+        # kernel_version: a pointer to the (NUL-terminated) version string, relative to 0x200.
+        with open(kpath, 'rb') as fh:
+            hdr = fh.read(0x210)
+            if len(hdr) == 0x210 and hdr[0x202:0x206] == b'HdrS':
+                proto, = struct.unpack_from('<H', hdr, 0x206)
+                ptr, = struct.unpack_from('<H', hdr, 0x20e)
+                if proto >= 0x0200 and ptr:
+                    fh.seek(ptr + 0x200)
+                    verstr = fh.read(256).split(b'\x00', 1)[0].decode('utf-8', 'replace').split(None, 1)
+                    if verstr:
+                        return(verstr[0])
+            # Not a bzImage we can parse (or not x86); fall back to libmagic. It never looks past the first MiB
+            # anyways, so that's all we give it.
+            fh.seek(0)
+            magicname = magic.detect_from_content(fh.read(1048576))
+        names = [i.strip().split(None, 1) for i in magicname.name.split(',') if i.strip() != '']
+        for n in names:
+            if len(n) != 2:
+                continue
+            k, v = n
+            # Note: this only grabs the version number.
+            # If we want to get e.g. the build user/machine, date, etc.,
+            # then we need to do a join. Shouldn't be necessary, though.
+            if k.lower() == 'version':
+                return(v.split(None, 1)[0])
+        return(None)
+
 def parseArgs():
     args = argparse.ArgumentParser(description = ('Sync files to assist using mdadm RAID arrays with UEFI'))
     args.add_argument('-V', '--no-validate',
                       dest = 'validate',
                       action = 'store_false',
-                      help = ('If specified, do not attempt to validate the configuration file (-c/--cfg) against'
-                              'its schema (otherwise it is fetched dynamically and requires network connection)'))
+                      help = ('If specified, do not attempt to validate the configuration file (-c/--cfg) against '
+                              'its schema (otherwise it is fetched dynamically and cached alongside -s/--state, '
+                              'falling back to the cached or bundled copy if offline)'))
     args.add_argument('-c', '--cfg',
                       dest = 'cfg',
                       default = '/etc/bootsync.xml',
                       help = ('The path to the bootsync configuration file. Default is /etc/bootsync.xml'))
+    args.add_argument('-s', '--state',
+                      dest = 'statefile',
+                      default = '/var/cache/bootsync/state.json',
+                      help = ('The path to the file to store file hashes in between runs, so unchanged files are not '
+                              'rehashed. Default is /var/cache/bootsync/state.json'))
     args.add_argument('-n', '--dry-run',
                       dest = 'dryrun',
                       action = 'store_true',
@@ -321,6 +570,7 @@ def main():
     bs = BootSync(**args)
     bs.sync(**args)
     bs.writeConfs(**args)
+    bs.writeState(**args)
     return()
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import struct
+import tempfile
+import timeit
+##
+import magic  # From http://darwinsys.com/file/, not https://github.com/ahupp/python-magic
+import bootsync
+
+
+# Compares reading the kernel version from the bzImage header against handing libmagic the whole image (the old way)
+# and a 1 MiB prefix (the fallback). Without -k/--kernel, a synthetic image is generated.
+
+def gen_kernel(fpath, size):
+    buf = bytearray(size)
+    ver = b'6.1.2-arch1-1 (linux@archlinux) #1 SMP PREEMPT_DYNAMIC Sat, 31 Dec 2022 17:40:35 +0000\x00'
+    ptr = 0x3ac0
+    buf[0x1fe:0x200] = b'\x55\xaa'
+    buf[0x202:0x206] = b'HdrS'
+    buf[0x206:0x208] = struct.pack('<H', 0x020f)
+    buf[0x20e:0x210] = struct.pack('<H', ptr)
+    buf[ptr + 0x200:ptr + 0x200 + len(ver)] = ver
+    with open(fpath, 'wb') as fh:
+        fh.write(buf)
+    return()
+
+def magic_full(kpath):
+    with open(kpath, 'rb') as fh:
+        return(magic.detect_from_content(fh.read()).name)
+
+def magic_prefix(kpath):
+    with open(kpath, 'rb') as fh:
+        return(magic.detect_from_content(fh.read(1048576)).name)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark kernel version detection methods.')
+    args.add_argument('-k', '--kernel',
+                      dest = 'kernel',
+                      default = None,
+                      help = 'A real kernel image to test against (e.g. /boot/vmlinuz-linux)')
+    args.add_argument('-n', '--number',
+                      dest = 'number',
+                      type = int,
+                      default = 200,
+                      help = 'How many times to run each method. Default is 200')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    kpath = args['kernel']
+    tmpfile = None
+    if not kpath:
+        tmpfile = tempfile.NamedTemporaryFile(prefix = '.kernver_bench.', delete = False)
+        tmpfile.close()
+        kpath = tmpfile.name
+        gen_kernel(kpath, 12582912)
+    bs = bootsync.BootSync.__new__(bootsync.BootSync)
+    try:
+        print('Version: {0}'.format(bs._getKernelVersion(kpath)))
+        for name, func in (('header', bs._getKernelVersion),
+                           ('libmagic (1 MiB prefix)', magic_prefix),
+                           ('libmagic (whole file)', magic_full)):
+            t = timeit.timeit(lambda: func(kpath), number = args['number'])
+            print('{0:>24}: {1:8.3f} ms/call'.format(name, t / args['number'] * 1000))
+    finally:
+        if tmpfile:
+            os.remove(kpath)
+    return()
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,366 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import hashlib
 import os
+import sqlite3
+import stat
+import sys
+import time
 
 
-_supported_hashes = hashlib.algorithms_available
+# Find duplicate files while reading as little as possible:
+# 1.) Group files by size (free; it's just a stat). A size with only one file can't have a duplicate.
+# 2.) For the remaining, hash the first and last few KiB of each and regroup on that.
+# 3.) Only files still sharing a partial hash get fully hashed.
+# Hardlinks (same st_dev and st_ino) are the same data, so each inode is only ever read once.
+# Optionally, hashes are kept in an sqlite cache (HashCache) so unchanged files aren't reread on the next run.
+# Hashing in stages 2 and 3 is spread over a pool of threads (hashlib releases the GIL on large updates) or processes.
+
+def _fixed_hashes():
+    # Variable-length algorithms (shake_128/shake_256) have a digest_size of 0 and need a length for hexdigest(), and
+    # OpenSSL may list some it can't actually construct (e.g. md4 without its legacy provider); leave both out.
+    out = set()
+    for h in hashlib.algorithms_available:
+        try:
+            if hashlib.new(h).digest_size:
+                out.add(h)
+        except ValueError:
+            pass
+    return(out)
+
+_supported_hashes = _fixed_hashes()
 
 
 class Hasher(object):
-    def __init__(self, hashalgo = None):
+    def __init__(self, hashalgo = 'sha256', partial_size = 4096, bufsize = 1048576):
         if hashalgo not in _supported_hashes:
             raise ValueError('hashalgo not in supported hash algorithm types')
-        self.hash = hashlib.new(hashalgo)
-        self.hashes = {}
+        self.hashalgo = hashalgo
+        self.partial_size = partial_size
+        self.bufsize = bufsize
+
+    def partial(self, fpath, size):
+        # Hashes the first and last partial_size bytes of fpath. If the file is small enough that those overlap,
+        # this is just the full hash.
+        _hash = hashlib.new(self.hashalgo)
+        with open(fpath, 'rb') as fh:
+            if size <= (self.partial_size * 2):
+                _hash.update(fh.read())
+            else:
+                _hash.update(fh.read(self.partial_size))
+                fh.seek(-self.partial_size, os.SEEK_END)
+                _hash.update(fh.read(self.partial_size))
+        return(_hash.hexdigest())
+
+    def full(self, fpath):
+        _hash = hashlib.new(self.hashalgo)
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        with open(fpath, 'rb') as fh:
+            while True:
+                n = fh.readinto(buf)
+                if not n:
+                    break
+                _hash.update(view[:n])
+        return(_hash.hexdigest())
+
+
+def _hash_file(hasher, fpath, size, kind):
+    # Module-level so it can be pickled for a process pool.
+    if kind == 'full':
+        return(hasher.full(fpath))
+    return(hasher.partial(fpath, size))
+
+
+class HashCache(object):
+    # An on-disk cache of file hashes. An entry is only used if the device, inode, size, mtime (in ns), algorithm
+    # and kind (full or partial, with the partial size) all still match; a changed file simply replaces its old entry.
+    def __init__(self, dbpath):
+        self.dbpath = os.path.abspath(os.path.expanduser(dbpath))
+        os.makedirs(os.path.dirname(self.dbpath), exist_ok = True)
+        self.db = sqlite3.connect(self.dbpath)
+        self.db.execute(('CREATE TABLE IF NOT EXISTS hashes ('
+                         'dev INTEGER NOT NULL, '
+                         'ino INTEGER NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'mtime_ns INTEGER NOT NULL, '
+                         'algo TEXT NOT NULL, '
+                         'kind TEXT NOT NULL, '
+                         'digest TEXT NOT NULL, '
+                         'last_used INTEGER NOT NULL, '
+                         'PRIMARY KEY (dev, ino, algo, kind))'))
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'bytes_avoided': 0,
+                      'pruned': 0}
+        self._now = int(time.time())
+
+    def get(self, dev, ino, size, mtime_ns, algo, kind, nbytes):
+        # nbytes is how much we'd have to read to hash it ourselves; it's only used for the stats.
+        row = self.db.execute(('SELECT digest FROM hashes '
+                               'WHERE dev = ? AND ino = ? AND algo = ? AND kind = ? AND size = ? AND mtime_ns = ?'),
+                              (dev, ino, algo, kind, size, mtime_ns)).fetchone()
+        if not row:
+            self.stats['misses'] += 1
+            return(None)
+        self.db.execute('UPDATE hashes SET last_used = ? WHERE dev = ? AND ino = ? AND algo = ? AND kind = ?',
+                        (self._now, dev, ino, algo, kind))
+        self.stats['hits'] += 1
+        self.stats['bytes_avoided'] += nbytes
+        return(row[0])
+
+    def put(self, dev, ino, size, mtime_ns, algo, kind, digest):
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (dev, ino, size, mtime_ns, algo, kind, digest, self._now))
+        return()
+
+    def prune(self, max_age_days):
+        # Drop anything that hasn't been used in max_age_days (e.g. files that were deleted or volumes that are
+        # no longer scanned).
+        c = self.db.execute('DELETE FROM hashes WHERE last_used < ?',
+                            (self._now - (max_age_days * 86400), ))
+        self.stats['pruned'] += c.rowcount
+        return()
+
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return((self.stats['hits'] / total) if total else 0.0)
+
+    def close(self):
+        self.db.commit()
+        if self.stats['pruned']:
+            self.db.execute('VACUUM')
+        self.db.close()
+        return()
+
+
+class DupeFinder(object):
+    def __init__(self, paths, hashalgo = 'sha256', partial_size = 4096, min_size = 1, follow_links = False,
+                 cache = None, workers = None, pool = 'thread'):
+        if pool not in ('thread', 'process'):
+            raise ValueError('pool must be one of: thread, process')
+        self.paths = [os.path.abspath(os.path.expanduser(p)) for p in paths]
+        self.hasher = Hasher(hashalgo = hashalgo, partial_size = partial_size)
+        self.min_size = min_size
+        self.follow_links = follow_links
+        self.workers = (workers if workers else os.cpu_count())
+        self.pool = pool
+        # A HashCache, if we're using one.
+        self.cache = cache
+        # (st_dev, st_ino): [path, path, ...]
+        self.inodes = {}
+        # (st_dev, st_ino): st_mtime_ns
+        self.mtimes = {}
+        # size: [(st_dev, st_ino), ...]
+        self.sizes = {}
+        self.stats = {'files': 0,
+                      'hardlinks': 0,
+                      'partial_hashed': 0,
+                      'full_hashed': 0,
+                      'bytes_read': 0}
+        self.dupes = []
+
+    def scan(self):
+        for path in self.paths:
+            if os.path.isfile(path):
+                self._add(path)
+                continue
+            for root, dirs, files in os.walk(path, followlinks = self.follow_links):
+                for f in files:
+                    self._add(os.path.join(root, f))
+        return()
+
+    def _add(self, fpath):
+        try:
+            st = (os.stat(fpath) if self.follow_links else os.lstat(fpath))
+        except OSError:
+            return()
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+            return()
+        self.stats['files'] += 1
+        ino = (st.st_dev, st.st_ino)
+        if ino in self.inodes:
+            # Same data as something we've already seen; never read it again.
+            if fpath not in self.inodes[ino]:
+                self.inodes[ino].append(fpath)
+                self.stats['hardlinks'] += 1
+            return()
+        self.inodes[ino] = [fpath]
+        self.mtimes[ino] = st.st_mtime_ns
+        if st.st_size not in self.sizes:
+            self.sizes[st.st_size] = []
+        self.sizes[st.st_size].append(ino)
+        return()
+
+    def find(self):
+        self.scan()
+        self.dupes = []
+        _partial_kind = 'partial:{0}'.format(self.hasher.partial_size)
+        _executor = (concurrent.futures.ThreadPoolExecutor
+                     if self.pool == 'thread' else
+                     concurrent.futures.ProcessPoolExecutor)
+        with _executor(max_workers = self.workers) as executor:
+            jobs = []
+            for size, inodes in self.sizes.items():
+                if len(inodes) > 1:
+                    jobs.extend([(ino, size) for ino in inodes])
+            fulljobs = []
+            for candidates in self._group(executor, jobs, _partial_kind):
+                size = candidates[0][1]
+                if size <= (self.hasher.partial_size * 2):
+                    # The partial hash already covered the whole file.
+                    self.dupes.append([ino for ino, size in candidates])
+                else:
+                    fulljobs.extend(candidates)
+            for candidates in self._group(executor, fulljobs, 'full'):
+                self.dupes.append([ino for ino, size in candidates])
+        if self.cache:
+            self.cache.db.commit()
+        return(self.dupes)
+
+    def _group(self, executor, jobs, kind):
+        # jobs is a list of (inode, size). Returns a list of groups (lists) of jobs that share a size and hash,
+        # dropping any group with only one inode.
+        _digests = self._hash_all(executor, jobs, kind)
+        _hashes = {}
+        for ino, size in jobs:
+            if ino not in _digests:
+                continue  # Vanished or unreadable since the scan.
+            k = (size, _digests[ino])
+            if k not in _hashes:
+                _hashes[k] = []
+            _hashes[k].append((ino, size))
+        return([i for i in _hashes.values() if len(i) > 1])
+
+    def _hash_all(self, executor, jobs, kind):
+        # Returns a dict of inode: digest. Cache lookups/updates stay in this thread (sqlite connections can't be
+        # shared); only the actual reading/hashing goes to the pool. We keep at most a few jobs per worker in flight
+        # so a huge tree doesn't get queued up (and its results held) all at once.
+        digests = {}
+        pending = {}
+        maxpending = self.workers * 4
+        for ino, size in jobs:
+            nbytes = (size if kind == 'full' else min(size, self.hasher.partial_size * 2))
+            if self.cache:
+                digest = self.cache.get(*ino, size, self.mtimes[ino], self.hasher.hashalgo, kind, nbytes)
+                if digest:
+                    digests[ino] = digest
+                    continue
+            f = executor.submit(_hash_file, self.hasher, self.inodes[ino][0], size, kind)
+            pending[f] = (ino, size, nbytes)
+            if len(pending) >= maxpending:
+                done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    self._hash_done(f, pending.pop(f), kind, digests)
+        for f in concurrent.futures.as_completed(pending):
+            self._hash_done(f, pending[f], kind, digests)
+        return(digests)
+
+    def _hash_done(self, future, job, kind, digests):
+        ino, size, nbytes = job
+        try:
+            digest = future.result()
+        except OSError:
+            return()  # Vanished or unreadable since the scan.
+        if kind == 'full':
+            self.stats['full_hashed'] += 1
+        else:
+            self.stats['partial_hashed'] += 1
+        self.stats['bytes_read'] += nbytes
+        if self.cache:
+            self.cache.put(*ino, size, self.mtimes[ino], self.hasher.hashalgo, kind, digest)
+        digests[ino] = digest
+        return()
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = ('Find duplicate files, reading as little of each file as possible'))
+    args.add_argument('-a', '--algo',
+                      dest = 'hashalgo',
+                      choices = sorted(_supported_hashes),
+                      default = 'sha256',
+                      metavar = 'HASHALGO',
+                      help = ('The hash algorithm to use. Default is sha256'))
+    args.add_argument('-p', '--partial-size',
+                      dest = 'partial_size',
+                      type = int,
+                      default = 4096,
+                      help = ('How many bytes from the beginning and end of each file to hash before fully hashing '
+                              'it. Default is 4096'))
+    args.add_argument('-m', '--min-size',
+                      dest = 'min_size',
+                      type = int,
+                      default = 1,
+                      help = ('Ignore files smaller than this many bytes. Default is 1 (skip empty files)'))
+    args.add_argument('-L', '--follow-links',
+                      dest = 'follow_links',
+                      action = 'store_true',
+                      help = ('If specified, follow symlinks'))
+    args.add_argument('-c', '--cache',
+                      dest = 'cache',
+                      nargs = '?',
+                      const = '~/.cache/find_dupes.sqlite3',
+                      default = None,
+                      help = ('If specified, cache hashes in this sqlite database so unchanged files are not reread '
+                              'on later runs. If specified without a path, ~/.cache/find_dupes.sqlite3 is used'))
+    args.add_argument('-P', '--prune-days',
+                      dest = 'prune_days',
+                      type = int,
+                      default = 30,
+                      help = ('With -c/--cache, drop cache entries that have not been used in this many days. '
+                              'Default is 30'))
+    args.add_argument('-w', '--workers',
+                      dest = 'workers',
+                      type = int,
+                      default = os.cpu_count(),
+                      help = ('The number of hashing workers. Default is the number of CPUs ({0})').format(
+                                                                                                    os.cpu_count()))
+    args.add_argument('-t', '--pool',
+                      dest = 'pool',
+                      choices = ('thread', 'process'),
+                      default = 'thread',
+                      help = ('The type of worker pool to hash with. Default is thread'))
+    args.add_argument('-s', '--stats',
+                      dest = 'stats',
+                      action = 'store_true',
+                      help = ('If specified, print some statistics to stderr when done'))
+    args.add_argument('paths',
+                      nargs = '+',
+                      metavar = 'PATH',
+                      help = ('The file(s)/directory(ies) to search'))
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    cache = None
+    if args['cache']:
+        cache = HashCache(args['cache'])
+    finder = DupeFinder(args['paths'],
+                        hashalgo = args['hashalgo'],
+                        partial_size = args['partial_size'],
+                        min_size = args['min_size'],
+                        follow_links = args['follow_links'],
+                        cache = cache,
+                        workers = args['workers'],
+                        pool = args['pool'])
+    # Each group is separated by a blank line. Hardlinks to the same file are printed on the same line,
+    # separated by tabs.
+    groups = []
+    for group in finder.find():
+        groups.append('\n'.join(['\t'.join(sorted(finder.inodes[ino])) for ino in group]))
+    print('\n\n'.join(groups))
+    if cache:
+        cache.prune(args['prune_days'])
+        cache.close()
+    if args['stats']:
+        for k, v in finder.stats.items():
+            print('{0}: {1}'.format(k, v), file = sys.stderr)
+        if cache:
+            for k, v in cache.stats.items():
+                print('cache_{0}: {1}'.format(k, v), file = sys.stderr)
+            print('cache_hit_rate: {0:.1%}'.format(cache.hit_rate()), file = sys.stderr)
+    return()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+##
+import find_dupes
+
+
+# Times DupeFinder with each pool type and a range of worker counts over a generated tree of duplicate files.
+# Point -d/--dir at the disk you actually care about; a tmpfs will only tell you how fast the CPU can hash.
+
+def gen_tree(basedir, count, size):
+    # Every file gets exactly one duplicate, and all files are the same size, so everything goes through the full
+    # hash stage.
+    for i in range(count):
+        data = os.urandom(size)
+        for copy in ('a', 'b'):
+            d = os.path.join(basedir, copy)
+            os.makedirs(d, exist_ok = True)
+            with open(os.path.join(d, '{0:06d}'.format(i)), 'wb') as fh:
+                fh.write(data)
+    return()
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark find_dupes thread vs. process pools.')
+    args.add_argument('-n', '--count',
+                      dest = 'count',
+                      type = int,
+                      default = 200,
+                      help = 'The number of duplicated pairs of files to create. Default is 200')
+    args.add_argument('-S', '--size',
+                      dest = 'size',
+                      type = int,
+                      default = 8388608,
+                      help = 'The size of each file in bytes. Default is 8388608 (8 MiB)')
+    args.add_argument('-w', '--workers',
+                      dest = 'workers',
+                      type = int,
+                      nargs = '+',
+                      default = [1, 2, 4, 8],
+                      help = 'The worker counts to try. Default is 1 2 4 8')
+    args.add_argument('-d', '--dir',
+                      dest = 'dir',
+                      default = None,
+                      help = 'Where to create the test files. Default is the system temp directory')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    basedir = tempfile.mkdtemp(prefix = '.find_dupes_bench.', dir = args['dir'])
+    try:
+        gen_tree(basedir, args['count'], args['size'])
+        total = args['count'] * 2 * args['size']
+        for pool in ('thread', 'process'):
+            for workers in args['workers']:
+                finder = find_dupes.DupeFinder([basedir], workers = workers, pool = pool)
+                start = time.perf_counter()
+                dupes = finder.find()
+                elapsed = time.perf_counter() - start
+                print('{0:>7} x{1:<3} {2:>4} groups in {3:6.2f}s ({4:8.1f} MiB/s)'.format(pool,
+                                                                                   workers,
+                                                                                   len(dupes),
+                                                                                   elapsed,
+                                                                                   total / elapsed / 1048576))
+    finally:
+        shutil.rmtree(basedir)
+    return()
+
+if __name__ == '__main__':
+    main()